@@ -41,19 +41,26 @@ import microcontroller
 import watchdog
 import os
 import storage
+import asyncio
 
 import wifi
-import ssl
 
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
 from adafruit_io.adafruit_io import IO_MQTT  # , IO_HTTP
 import adafruit_logging as logging
 
 import compartment
+import doors
+import locks
+import topology
+import journal
 import ui
 import hardware
 import flink
 import networking
+import codes
+import scheduler
+from profiler import StageProfiler
 
 # version string
 version = "1.2.1"
@@ -137,10 +144,19 @@ def process_command(payload):
     elif command == "open" and len(payload) == 2:
         comp = payload[1]
         if comp == "all":
-            ui.open_all(compartments)
+            compartment.OpenAll(compartments, callback=lambda failed: logger.info(f"All compartments opened from MQTT broker, failed: {failed}."))
         elif int(comp) > 0 and int(comp) <= len(compartments):
-            compartments[comp].open()
+            compartments[comp].start_open(callback=lambda c, door_open: logger.info(f"Compartment {comp} opened from MQTT broker, door open: {door_open}."))
         logger.info(f"Compartment open sent from MQTT broker: {comp}")
+    elif command == "stats" and len(payload) == 1:
+        flink.log_stats(logger)
+    elif command == "profile" and len(payload) == 1:
+        io.publish(aio_feed_name + "status", profiler.snapshot())
+    elif command == "profile" and len(payload) == 2 and payload[1] == "reset":
+        profiler.reset()
+    elif command == "jobs" and len(payload) == 1:
+        for job in jobs:
+            logger.info(f"Job {job}")
     elif command == "reset" and len(payload) == 1:
         microcontroller.reset()
     elif command == "tamper_alarm" and len(payload) == 2:
@@ -199,6 +215,8 @@ def message(client, feed_id, payload):
         process_command(payload)
 
 # try to connect to MQTT broker and use it for logging
+mqtt_socket_timeout = 0.1  # s, granularity of MQTT socket reads
+mqtt_loop_timeout = 0.2  # s, longest check_mqtt() waits for messages, has to be above the socket timeout
 # Initialize a new MQTT Client object
 mqtt_client = MQTT.MQTT(
     broker="io.adafruit.com",
@@ -207,8 +225,9 @@ mqtt_client = MQTT.MQTT(
     username=aio_username,
     password=aio_key,
     socket_pool=networking.pool,
-    ssl_context=ssl.create_default_context(),
+    ssl_context=networking.ssl_context,  # shared with the Flink HTTP session
     keep_alive = 120,
+    socket_timeout=mqtt_socket_timeout,
 )
 try:
     # Initialize an MQTT broker MQTT Client
@@ -274,63 +293,46 @@ if len(hardware.port_expanders)*8 < compartment_number_saved:
     ui.maintainance_grid.hidden = False
 
 
-# calculate which spaces the large compartments take up.
-# spaces = spots/port expander connections where individual compartments could be
-# spaces formula: expander_index * 8 + compartment_per_expander + 1
-# large_compartment_spaces = {}
-for index in large_compartments:
-    space = int(index)  # TODO?: only works for first large compartment
-large_compartment_spaces = [space, space + 1, space + 8, space + 9]
+# map spaces (spots on the port expander rows where single compartments could be) to compartments, IO pins and LEDs
+try:
+    topology.build(len(hardware.port_expanders), topology.parse_layout(large_compartments))
+except ValueError as e:
+    logger.error(f"Invalid compartment layout {large_compartments}: {e}")
+    ui.maintainance_grid.hidden = False
+    topology.build(len(hardware.port_expanders), {})
 
 # create compartment objects with IO ports, and a dict for all of them
+doors.setup(hardware.port_expanders, hardware.door_irq)
+locks.setup(hardware.port_expanders)
+LED_connectors = (hardware.LED_connector_1, hardware.LED_connector_2)
 compartments = {}
-counter = 1
-for index, expander in enumerate(hardware.port_expanders):
-    for compartment_per_expander in range(8):
-        space = index * 8 + compartment_per_expander + 1
-        # large compartment handling
-        if space in large_compartment_spaces:
-            pos = large_compartment_spaces.index(space)
-            if pos == 0:  # first space: create comp as normal
-                pass  # skip to normal part
-            elif pos == 1 or pos == 3:  # second, fourth space: add LED to first
-                compartments[str(large_compartment_spaces[0])].LEDs.append(space - 1)
-                continue
-            elif pos == 2:  # third space: add IO to first, also LED
-                compartments[str(large_compartment_spaces[0])].add_input(expander.get_pin(compartment_per_expander * 2))
-                compartments[str(large_compartment_spaces[0])].add_output(expander.get_pin(compartment_per_expander * 2 + 1))
-                compartments[str(large_compartment_spaces[0])].LEDs.append(space - 1)
-                continue
-        # normal compartments
-        input_pin = expander.get_pin(compartment_per_expander * 2)
-        output_pin = expander.get_pin(compartment_per_expander * 2 + 1)
-        new_compartment = compartment.compartment(input_pin, output_pin)
-        new_compartment.LEDs = [space - 1]
-        new_compartment.LED_connector = hardware.LED_connector_1
-        compartments[f"{counter}"] = new_compartment
-        counter += 1
-
-
-# check door of all compartments
+for index, pins in enumerate(topology.io):
+    number = index + 1
+    new_compartment = None
+    for expander_index, input_pin, output_pin in pins:
+        if new_compartment is None:
+            new_compartment = compartment.compartment(number, expander_index, input_pin, output_pin)
+        else:  # tall and large compartments: IO of the space below
+            new_compartment.add_input(expander_index, input_pin)
+            new_compartment.add_output(expander_index, output_pin)
+    if topology.sizes[index] > 1:
+        new_compartment.type = "big"
+    new_compartment.LEDs = topology.LEDs[index]
+    new_compartment.LED_connector = LED_connectors[topology.connectors[index]]
+    compartments[str(number)] = new_compartment
+
+# restore door and content status from before the last reset
+replayed = journal.load(compartment.door_state, compartment.content_state, logger)
+logger.info(f"Compartment states restored, {replayed} journal records replayed.")
+
+# check door of all compartments, one read per port expander
 def check_all():
-    open_comps = []
-    for index in range(len(compartments)):
-        if compartments[str(index + 1)].get_inputs():
-            open_comps.append(str(index + 1))
-    return open_comps
+    return [str(number) for number in sorted(doors.open_compartments(logger))]
 
 # check if given code is in dict of valid codes, or a maintainance code. return compartment and status message
 def check_code(code):
     if len(code) == 4:  # normal codes have 4 digits
-        status_code, valid_codes = flink.get_codes(logger)  # get codes from Flink
-        if status_code is not 200:
-            logger.error(f"Error response from Flink when getting codes: {status_code}")
-            return None, "error"
-        if valid_codes is not None:
-            for comp, comp_codes in valid_codes.items():
-                if code in comp_codes:
-                    return comp, "normal"
-        return None, "invalid"
+        return codes.lookup(code, logger)  # answered from the local code cache, refreshed from Flink if too old
     elif len(code) == 8:  # maintainance codes have 8 digits
         if code[2:8] == maintainance_code:
             comp = int(code[0:2])
@@ -345,6 +347,14 @@ open_comps = check_all()
 if len(open_comps) is not 0:
     logger.warning(f"Open compartments: {open_comps}")
 
+# fill local code cache, codes saved on flash are used until Flink answers
+codes.load(logger)
+status_code = codes.refresh(logger)
+if status_code == 200:
+    logger.info("Codes loaded from Flink.")
+else:
+    logger.warning(f"Could not load codes from Flink: {status_code}.")
+
 logger.info("Startup complete.")
 
 #
@@ -352,7 +362,16 @@ logger.info("Startup complete.")
 #
 last_pressed = None
 code = ""
-counter = 0
+transaction = None # compartment dialogue in progress, keys go to it instead of the code entry
+
+# main loop stage timing, snapshot via the "profile" command
+profiler = StageProfiler(("keypad", "tamper", "wifi", "brightness", "mqtt", "status"))
+STAGE_KEYPAD = profiler.index("keypad")
+STAGE_TAMPER = profiler.index("tamper")
+STAGE_WIFI = profiler.index("wifi")
+STAGE_BRIGHTNESS = profiler.index("brightness")
+STAGE_MQTT = profiler.index("mqtt")
+STAGE_STATUS = profiler.index("status")
 
 logger.removeHandler(display_log)  # stop logging to display
 
@@ -362,41 +381,58 @@ microcontroller.watchdog.feed()
 
 hardware.LED_internal.fill((30, 30, 30))
 
-# debug, execution time profiling
-#last_time = time.monotonic()
 
-while True:
+# log entered code after the compartment dialogue is finished, with the updated door and content status
+def log_code(code, compartment_index):
+    # Flink code log, queued and uploaded in the background
+    flink.queue_code_log(logger, code, compartments, compartment_index)
+    if (compartment_index is not None) and (compartment_index in compartments):
+        logger.info(f"Code '{code}' was entered, valid for compartment {compartment_index}, content status: {compartments[compartment_index].content_status}, door status: {compartments[compartment_index].door_status}.")
+        # after logging, set status back to unknown - we do not want to rely on the user answering correctly/truthfully. TODO?: this makes part of the status query code useless, remove?
+        # compartments[compartment_index].content_status = "unknown"
+    elif compartment_index == "99":
+        logger.info("Maintainance code to open all compartments was entered.")
+    else:
+        logger.info(f"Code '{code}' was entered, invalid")
+
+
+# read keypad, process entered codes
+def check_keypad():
+    global last_pressed, code, transaction
+    start = profiler.start()
     key = hardware.read_keypad()  # read into buffer
+    profiler.stop(STAGE_KEYPAD, start)
+    pressed = None
     if key != last_pressed:
         last_pressed = key
-        if key is not None:
-            hardware.haptic.play()
-            if key is "✓":  # process input
-                compartment_index, status = check_code(code)  # check if the code is in the list and return the compartment index if yes, None if not
-                ui.process_compartment(compartments, compartment_index, logger)
-                if status == "maintainance":
-                    code = "maintainance"
-                # Flink code log
-                response = flink.post_code_log(logger, code, compartments, compartment_index)
-                if (compartment_index is not None) and (compartment_index in compartments):
-                    logger.info(f"Code '{code}' was entered, valid for compartment {compartment_index}, content status: {compartments[compartment_index].content_status}, door status: {compartments[compartment_index].door_status}.")
-                    # after logging, set status back to unknown - we do not want to rely on the user answering correctly/truthfully. TODO?: this makes part of the status query code useless, remove?
-                    # compartments[compartment_index].content_status = "unknown"
-                elif compartment_index == "99":
-                    logger.info("Maintainance code to open all compartments was entered.")
-                else:
-                    logger.info(f"Code '{code}' was entered, invalid")
-                code = ""
-                ui.code_label.text = code
-            elif key is "x":  # clear input
-                code = ""
+        pressed = key
+    if transaction is not None:  # dialogue in progress, advance it
+        if transaction.update(pressed):
+            log_code(code, transaction.compartment_index)
+            transaction = None
+            code = ""
+            ui.code_label.text = code
+        return
+    if pressed is not None:
+        hardware.haptic.play()
+        if pressed is "✓":  # process input
+            compartment_index, status = check_code(code)  # check if the code is in the list and return the compartment index if yes, None if not
+            if status == "maintainance":
+                code = "maintainance"
+            transaction = ui.Transaction(compartments, compartment_index, logger)
+        elif pressed is "x":  # clear input
+            code = ""
+            ui.code_label.text = code
+        elif len(code) < 8:  # add number to code, ignore anything above 8 chars
+            code = code + pressed
+            if len(code) <= 4:
                 ui.code_label.text = code
-            elif len(code) < 8:  # add number to code, ignore anything above 8 chars
-                code = code + key
-                if len(code) <= 4:
-                    ui.code_label.text = code
 
+
+# check accelerometer for tampering
+def check_tamper():
     if hardware.accelerometer is not None and tamper_alarm == "on":
+        start = profiler.start()
         x, y, z = hardware.accelerometer.acceleration  # in m/s2
         if abs(z) > 1:  # check accelerometer
             # TODO: message on screen
@@ -405,73 +441,142 @@ while True:
         else:
             hardware.LED_internal.fill((0, 0, 0))
             hardware.piezo.duty_cycle = 0
+        profiler.stop(STAGE_TAMPER, start)
+
+
+# feed watchdog, check wifi, update connection icons
+def check_connectivity():
+    global wifi_connected
+    microcontroller.watchdog.feed()  # reset the watchdog timer
+
+    # check wifi, reconnect if necessary, update icon
+    start = profiler.start()
+    try:
+        wifi_connected = networking.reconnect_wifi()
+    except Exception as e:
+        logger.error(f"Error reconnecting to wifi: {e}")
+        wifi_connected = False
+    ui.no_wifi_grid.hidden = wifi.radio.connected
+    profiler.stop(STAGE_WIFI, start)
+
+    # Flink icon shown while calls to Flink fail (circuit breaker) or Flink rejects the box (4xx on the status put)
+    ui.no_flink_grid.hidden = flink.breaker.is_closed() and not flink.rejected
+
+    # check grid power connection
+    ui.no_power_grid.hidden = True # disabled, unreliable # hardware.supply_present.value
+
 
+# refresh local code cache in the background, check_code() answers from it
+def refresh_codes():
+    if codes.refresh_due():
+        codes.refresh(logger)
 
-    if counter % 101 == 0:  # runs roughly every 5 s
-        microcontroller.watchdog.feed()  # reset the watchdog timer
 
-        # check wifi, reconnect if necessary, update icon
+# background Flink calls, one per run of the network job, so a slow call delays keypad handling at most once per run
+network_steps = (
+    refresh_codes,
+    lambda: flink.flush_code_log(logger),  # queued code logs
+    lambda: doors.upload(logger, flink.post_door_log),  # door events
+    flink_log_handler.upload,  # error logs
+)
+network_step = 0
+
+
+def run_network_step():
+    global network_step
+    if not wifi_connected:
+        return
+    step = network_steps[network_step]
+    network_step = (network_step + 1) % len(network_steps)
+    step()
+
+
+# record door events, the expanders are read after an interrupt (or every time without the interrupt line)
+doors_failing = False  # errors are logged once until a read succeeds again
+
+
+def check_doors():
+    global doors_failing
+    try:
+        doors.check(logger)
+        if doors_failing:
+            logger.info("Reading door switches works again.")
+            doors_failing = False
+    except Exception as e:
+        if not doors_failing:
+            logger.error(f"Error reading door switches: {e}")
+            doors_failing = True
+
+
+# adjust display and LED brightness to ambient light
+def check_brightness():
+    if hardware.light_sensor is not None:
+        start = profiler.start()
         try:
-            wifi_connected = networking.connect_wifi()
+            light = hardware.light_sensor.visible_plus_ir_light - hardware.light_sensor.ir_light  # check brightness
+            if light > 100:  # > 100 is relatively bright, > 1000 very bright
+                light = 100
+            elif light < 0:
+                light = 0
+            hardware.backlight.duty_cycle = int((0.1 + 0.9 * light / 100) * 65535)
+            hardware.LED_internal.brightness = 0.1 + 0.9 * light / 100
+            hardware.LED_connector_1.brightness = 0.1 + 0.9 * light / 100
+            hardware.LED_connector_2.brightness = 0.1 + 0.9 * light / 100
         except Exception as e:
-            logger.error(f"Error reconnecting to wifi: {e}")
-            wifi_connected = False
-        ui.no_wifi_grid.hidden = wifi.radio.connected
-
-        # check grid power connection
-        ui.no_power_grid.hidden = True # disabled, unreliable # hardware.supply_present.value
-
-        if hardware.light_sensor is not None:
-            try:
-                light = hardware.light_sensor.visible_plus_ir_light - hardware.light_sensor.ir_light  # check brightness
-                if light > 100:  # > 100 is relatively bright, > 1000 very bright
-                    light = 100
-                elif light < 0:
-                    light = 0
-                hardware.backlight.duty_cycle = int((0.1 + 0.9 * light / 100) * 65535)
-                hardware.LED_internal.brightness = 0.1 + 0.9 * light / 100
-                hardware.LED_connector_1.brightness = 0.1 + 0.9 * light / 100
-                hardware.LED_connector_2.brightness = 0.1 + 0.9 * light / 100
-            except Exception as e:
-                logger.error(f"Error getting ambient brightness: {e}")
-
-    if counter % 301 == 0:  # runs roughly every 15 s
+            logger.error(f"Error getting ambient brightness: {e}")
+        profiler.stop(STAGE_BRIGHTNESS, start)
+
+
+# get updates from MQTT broker
+def check_mqtt():
+    start = profiler.start()
+    try:
+        io.loop(timeout=mqtt_loop_timeout)  # returns after mqtt_loop_timeout if no message arrives
+    except Exception as e:
+        logger.error(f"Error getting update from MQTT broker: {e}")
         try:
-            io.loop()  # get updates from MQTT broker, takes 1-2 s
-        except Exception as e:
-            logger.error(f"Error getting update from MQTT broker: {e}")
-            try:
-                io.reconnect()
-            except Exception:
-                logger.error(f"Error reconnecting to MQTT broker: {e}")
-
-    if counter == 6001:  # runs roughly every 5 minutes
-        counter = 0
-        #logger.info(f"5 min task")
-        # send status as keepalive
-        status_code = flink.put_status(logger, time.monotonic(), SN, version, compartment_number_saved, large_compartments)
-        if status_code is not 200:
-            logger.warning(f"Response from Flink: {status_code}.")
-            ui.no_flink_grid.hidden = False
+            io.reconnect()
+        except Exception:
+            logger.error(f"Error reconnecting to MQTT broker: {e}")
+    profiler.stop(STAGE_MQTT, start)
+
+
+# send status as keepalive, check battery, nightly reset
+def send_status():
+    start = profiler.start()
+    status_code = flink.put_status(logger, time.monotonic(), SN, version, compartment_number_saved, large_compartments)
+    profiler.stop(STAGE_STATUS, start)
+    if status_code is not 200:
+        logger.warning(f"Response from Flink: {status_code}.")
+        ui.no_flink_grid.hidden = False
+    else:
+        ui.no_flink_grid.hidden = True
+
+    # check battery status
+    if hardware.battery_monitor is not None:
+        if hardware.battery_monitor.cell_voltage < 3.5:  # log if low battery
+            logger.warning(f"Battery low: {hardware.battery_monitor.cell_voltage:.2f}V, {hardware.battery_monitor.cell_percent:.1f} %")
+            ui.low_battery_grid.hidden = False
         else:
-            ui.no_flink_grid.hidden = True
-
-        # check battery status
-        if hardware.battery_monitor is not None:
-            if hardware.battery_monitor.cell_voltage < 3.5:  # log if low battery
-                logger.warning(f"Battery low: {battery_monitor.cell_voltage:.2f}V, {battery_monitor.cell_percent:.1f} %")
-                ui.low_battery_grid.hidden = False
-            else:
-                ui.low_battery_grid.hidden = True
-
-        # regularly reset device, eg at 3 AM. if time says 3 and runtime is > 3:20 h -> reset.
-        # time.monotonic criterion prevents repeated resets between 3 and 4, and prevents resets 3h after restart if time is not realtime
-        if time.localtime().tm_hour == 3 and time.monotonic() > 12000:
-            microcontroller.reset()
-
-    counter += 1
-    time.sleep(0.045)  # goal repetition time is 50 ms
-    #time_now = time.monotonic()
-    #print(f"{time_now - last_time}") # debug: timing check
-    #last_time = time_now
+            ui.low_battery_grid.hidden = True
+
+    # regularly reset device, eg at 3 AM. if time says 3 and runtime is > 3:20 h -> reset.
+    # time.monotonic criterion prevents repeated resets between 3 and 4, and prevents resets 3h after restart if time is not realtime
+    if time.localtime().tm_hour == 3 and time.monotonic() > 12000:
+        microcontroller.reset()
+
 
+# periodic jobs, each runs as cooperative task on a fixed deadline schedule. the other jobs run while one is waiting
+jobs = [
+    scheduler.PeriodicJob("keypad", check_keypad, 0.01 if hardware.touch_irq is not None else 0.05),  # with the IRQ, polling only checks the event queue
+    scheduler.PeriodicJob("tamper", check_tamper, 0.05),
+    scheduler.PeriodicJob("locks", compartment.update_all, 0.05),  # advance non-blocking compartment open operations
+    scheduler.PeriodicJob("doors", check_doors, 0.05 if hardware.door_irq is not None else 0.5),  # door events, with the IRQ only the event queue is checked
+    scheduler.PeriodicJob("connectivity", check_connectivity, 5),
+    scheduler.PeriodicJob("network", run_network_step, 1),  # each step runs every len(network_steps) s
+    scheduler.PeriodicJob("brightness", check_brightness, 5),
+    scheduler.PeriodicJob("mqtt", check_mqtt, 2),
+    scheduler.PeriodicJob("status", send_status, 300, delay=300),  # status was sent at startup
+]
+
+asyncio.run(scheduler.run_all(jobs, logger))
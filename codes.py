@@ -0,0 +1,262 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# local code cache: valid codes are kept in RAM and refreshed from Flink in the background
+# the codes are also persisted to flash with their validity window, to check codes when Flink is unreachable
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import time
+
+import flink
+from outbox import max_backoff
+from codetable import CodeTable, record_size, max_compartment, max_time
+
+# refresh interval and maximum age (staleness) of the cached codes in seconds, overridable in settings.toml
+refresh_interval = os.getenv("CODE_REFRESH_INTERVAL") or 60
+max_age = os.getenv("CODE_MAX_AGE") or 900
+# offline validity of codes sent by Flink without a validity window, counted from when Flink last confirmed them
+offline_validity = os.getenv("OFFLINE_CODE_VALIDITY") or 86400
+# maximum number of codes, the tables are allocated once at boot
+capacity = os.getenv("CODE_CAPACITY") or 1000
+
+# codes file on CIRCUITPY, contains the records of the code table
+offline_file = "/codes.bin"
+max_code = 9999  # 4 digit codes
+NO_WINDOW = 0x01  # flag: Flink sent no window, valid offline until offline_validity after the last confirmation
+# RTC time of the last successful refresh, all codes in the table were confirmed by Flink then. saved to flash at most
+# every confirm_save_interval seconds (after a reset, offline validity is counted from the saved time)
+confirmed_file = "/codes_confirmed.txt"
+confirm_save_interval = 3600
+last_confirmed = None
+saved_confirmed = None
+
+table = CodeTable(capacity)  # active codes, same records as the codes file
+received = CodeTable(capacity)  # codes being received from Flink, swapped with table if the stored codes changed
+matched = bytearray(capacity)  # per record of table: also received unchanged
+added = bytearray(capacity)  # per record of received: not in table yet
+last_update = None  # time.monotonic() of the last successful refresh
+last_status = None  # status code (or exception) of the last refresh attempt
+next_refresh = None  # time.monotonic() when the next refresh attempt is due, None before the first attempt
+retry_delay = 0  # seconds between failed attempts, doubled for every further failure up to max_backoff
+
+
+# seconds since the last successful refresh, None if the cache was never filled
+def age():
+    if last_update is None:
+        return None
+    return time.monotonic() - last_update
+
+
+# cache can be used to answer code checks
+def is_valid():
+    return last_update is not None and age() <= max_age
+
+
+# cache should be refreshed. failed attempts are repeated after retry_delay, so an unreachable Flink does not block
+# the main loop on every check
+def refresh_due():
+    return next_refresh is None or time.monotonic() >= next_refresh
+
+
+# current RTC time in seconds, None if the RTC was not set (e.g. no NTP at boot)
+def current_time():
+    if time.localtime().tm_year < 2023:
+        return None
+    return int(time.time())
+
+
+# convert a time from Flink (seconds or ISO 8601 string, UTC if no offset given) to RTC seconds, 0 if not given
+def parse_time(value):
+    if value is None or value == "":
+        return 0
+    if type(value) is not str:
+        return int(value)
+    offset = 0
+    if value.endswith("Z"):
+        value = value[:-1]
+    elif len(value) > 19 and value[-6] in "+-":  # offset like +02:00
+        offset = int(value[-5:-3]) * 3600 + int(value[-2:]) * 60
+        if value[-6] == "-":
+            offset = -offset
+        value = value[:-6]
+    date, clock = value.split("T")
+    year, month, day = date.split("-")
+    hour, minute, second = clock.split(":")
+    timestamp = int(time.mktime((int(year), int(month), int(day), int(hour), int(minute), int(float(second)), 0, -1, -1)))
+    return timestamp - offset
+
+
+def in_window(start, end, now):
+    return start <= now and (end == 0 or now <= end)
+
+
+
+# collects the codes streamed from Flink into the received table. codes without validity window are stored without
+# times, so that unchanged codes give unchanged records. their offline validity follows last_confirmed
+class RecordBuilder():
+    def __init__(self, logger):
+        self.logger = logger
+        self.matched = 0  # number of records of table received unchanged
+        self.full = False
+        received.clear()
+        for pos in range(table.count):
+            matched[pos] = 0
+
+    def add(self, comp, code, valid_from, valid_until):
+        try:
+            if type(code) is not str and type(code) is not int:  # also rejects true/false
+                raise TypeError(f"code {code} is not a string or number")
+            code = int(code)
+            comp = int(comp)
+            if code < 0 or code > max_code:
+                raise ValueError(f"code {code} out of range")
+            if comp < 1 or comp > max_compartment:
+                raise ValueError("compartment out of range")
+            if valid_from is None and valid_until is None:
+                flags = NO_WINDOW
+                start = 0
+                end = 0
+            else:
+                flags = 0
+                start = parse_time(valid_from)
+                end = parse_time(valid_until)
+                if start < 0 or start > max_time or end < 0 or end > max_time:
+                    raise ValueError(f"validity window {valid_from} - {valid_until} out of range")
+        except (ValueError, TypeError) as e:
+            self.logger.warning(f"Ignoring invalid code entry for compartment {comp}: {e}")
+            return
+        old = table.find(code, comp)
+        if old >= 0:
+            old_record = table.record(old)
+        pos = received.add(code, comp, flags, start, end)
+        if pos < 0:
+            if not self.full:
+                self.logger.warning(f"Code table full, ignoring codes above {capacity}.")
+                self.full = True
+            return
+        if old >= 0 and old_record == (code, comp, flags, start, end):
+            added[pos] = 0
+            if not matched[old]:
+                matched[old] = 1
+                self.matched += 1
+        else:
+            added[pos] = 1
+
+
+# write records to flash. fails if the filesystem is not writable (USB connected)
+def save(data, append, logger):
+    try:
+        with open(offline_file, "ab" if append else "wb") as file:
+            file.write(data)
+    except OSError as e:
+        logger.warning(f"Could not save codes to flash: {e}")
+
+
+# replace the cache with the received codes. if all stored codes are unchanged, the new ones are only appended
+def store(builder, logger):
+    global table, received
+    if builder.matched == table.count:
+        first = table.count
+        for pos in range(received.count):
+            if added[pos]:
+                table.add_record(received, pos)
+        if table.count > first:
+            save(table.data(first), True, logger)
+            table.sort()
+    else:
+        table, received = received, table
+        save(table.data(), False, logger)
+        table.sort()
+
+
+# remember when Flink last confirmed the codes, written to flash only every confirm_save_interval
+def confirm(logger):
+    global last_confirmed, saved_confirmed
+    now = current_time()
+    if now is None:
+        return
+    last_confirmed = now
+    if saved_confirmed is None or now - saved_confirmed >= confirm_save_interval:
+        try:
+            with open(confirmed_file, "w") as file:
+                file.write(str(now))
+            saved_confirmed = now
+        except OSError as e:
+            logger.warning(f"Could not save code confirmation time to flash: {e}")
+
+
+# load records from flash, called at boot to be able to check codes before/without Flink
+def load(logger):
+    global last_confirmed, saved_confirmed
+    try:
+        with open(confirmed_file, "r") as file:
+            last_confirmed = saved_confirmed = int(file.read())
+    except (OSError, ValueError):
+        last_confirmed = saved_confirmed = None
+    table.clear()
+    try:
+        with open(offline_file, "rb") as file:
+            length = file.readinto(table.records)
+            partial = file.read(1) != b""
+    except OSError:  # no file yet
+        return 0
+    table.count = length // record_size
+    if length % record_size != 0 or partial:  # drop partially written record or codes above capacity
+        save(table.data(), False, logger)
+    table.sort()
+    logger.info(f"{table.count} codes loaded from flash.")
+    return table.count
+
+
+# get codes from Flink and replace the cache, keeps the old codes if the request fails
+def refresh(logger):
+    global last_update, last_status, next_refresh, retry_delay
+    builder = RecordBuilder(logger)
+    status_code, count = flink.get_codes(logger, builder.add)
+    last_status = status_code
+    if status_code == 200:
+        store(builder, logger)
+        confirm(logger)
+        last_update = time.monotonic()
+        retry_delay = 0
+        next_refresh = last_update + refresh_interval
+    else:
+        retry_delay = min(max(retry_delay * 2, refresh_interval), max_backoff)
+        next_refresh = time.monotonic() + retry_delay
+    return status_code
+
+
+# find the compartment for a 4 digit code. answers from the cache, only goes to Flink if the cache is too old.
+# if Flink is unreachable, the codes are checked against their validity window using the RTC
+def lookup(code, logger):
+    offline = False
+    if not is_valid():
+        if refresh_due():
+            status_code = refresh(logger)
+            if status_code != 200 and not isinstance(status_code, flink.CircuitOpenError):  # open circuit: logged by flink
+                logger.error(f"Error response from Flink when getting codes: {status_code}")
+        offline = not is_valid()  # last attempt failed, check against the validity windows until the next retry
+    now = current_time()
+    if offline and now is None:  # no way to check validity windows
+        return None, "error"
+    code = int(code)
+    i = table.first(code)
+    if i < 0:
+        return None, "invalid"
+    while i < table.count and table.codes[i] == code:  # several entries if the code is valid for several compartments
+        entry_code, comp, flags, start, end = table.record(table.positions[i])
+        i += 1
+        if flags & NO_WINDOW and not offline:  # Flink says it is valid now
+            return str(comp), "normal"
+        if offline and flags & NO_WINDOW:  # valid for offline_validity after Flink last confirmed it
+            if last_confirmed is not None and now <= last_confirmed + offline_validity:
+                logger.info(f"Code checked offline, valid for compartment {comp}.")
+                return str(comp), "normal"
+            continue
+        if now is None or in_window(start, end, now):
+            if offline:
+                logger.info(f"Code checked offline, valid for compartment {comp}.")
+            return str(comp), "normal"
+    return None, "invalid"
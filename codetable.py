@@ -0,0 +1,108 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# compact code table: fixed size records plus a sorted array of codes for binary search
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import struct
+from array import array
+
+# record: code, compartment, flags, valid from, valid until (RTC seconds, UTC). same layout as the codes file
+record_format = "<HBBII"
+record_size = struct.calcsize(record_format)
+max_compartment = 0xFF  # largest values that fit the record, struct may truncate silently on CircuitPython
+max_time = 0xFFFFFFFF
+
+
+# all memory is allocated once with the table, adding and sorting codes does not allocate
+class CodeTable():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.records = bytearray(capacity * record_size)
+        self.codes = array("H")  # codes sorted ascending, 2 bytes per code
+        self.positions = array("H")  # record number of each entry in codes, 2 bytes per code
+        for _ in range(capacity):
+            self.codes.append(0)
+            self.positions.append(0)
+
+    def clear(self):
+        self.count = 0
+
+    # add a record, returns its record number or -1 if the table is full. call sort() after adding
+    def add(self, code, comp, flags, start, end):
+        if self.count >= self.capacity:
+            return -1
+        if code < 0 or code > 0xFFFF or comp < 0 or comp > max_compartment or start < 0 or start > max_time or end < 0 or end > max_time:
+            raise ValueError("record value out of range")
+        struct.pack_into(record_format, self.records, self.count * record_size, code, comp, flags, start, end)
+        self.count += 1
+        return self.count - 1
+
+    # copy a record from another table
+    def add_record(self, other, pos):
+        if self.count >= self.capacity:
+            return -1
+        start = self.count * record_size
+        self.records[start:start + record_size] = other.records[pos * record_size:(pos + 1) * record_size]
+        self.count += 1
+        return self.count - 1
+
+    # (code, compartment, flags, valid from, valid until) of a record number
+    def record(self, pos):
+        return struct.unpack_from(record_format, self.records, pos * record_size)
+
+    # records as bytes, e.g. to write them to a file
+    def data(self, first=0):
+        return memoryview(self.records)[first * record_size:self.count * record_size]
+
+    # rebuild the sorted code array, shell sort in place (no sort() for arrays in CircuitPython).
+    # equal codes stay in record order, so the first compartment received for a code is found first
+    def sort(self):
+        codes = self.codes
+        positions = self.positions
+        count = self.count
+        for pos in range(count):
+            codes[pos] = struct.unpack_from("<H", self.records, pos * record_size)[0]
+            positions[pos] = pos
+        gap = count // 2
+        while gap > 0:
+            for i in range(gap, count):
+                code = codes[i]
+                position = positions[i]
+                j = i
+                while j >= gap and (codes[j - gap] > code or (codes[j - gap] == code and positions[j - gap] > position)):
+                    codes[j] = codes[j - gap]
+                    positions[j] = positions[j - gap]
+                    j -= gap
+                codes[j] = code
+                positions[j] = position
+            gap = gap // 2
+
+    # index of the first occurrence of a code in the sorted array, -1 if not found (binary search)
+    def first(self, code):
+        codes = self.codes
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if codes[middle] < code:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and codes[low] == code:
+            return low
+        return -1
+
+    # record number of a code for a compartment, -1 if not found
+    def find(self, code, comp):
+        i = self.first(code)
+        if i < 0:
+            return -1
+        while i < self.count and self.codes[i] == code:
+            pos = self.positions[i]
+            if self.records[pos * record_size + 2] == comp:
+                return pos
+            i += 1
+        return -1
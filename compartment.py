@@ -5,60 +5,184 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
 import time
-import digitalio
+
+import doors
+import locks
+import journal
 
 maximum_on_time = 5 # set maximum lock on time
 check_time = 0.5 # time to sleep between door checks
 
+# 12V power budget for opening several compartments at once
+lock_current = os.getenv("LOCK_CURRENT") or 500 # mA per energised lock output
+current_budget = os.getenv("LOCK_CURRENT_BUDGET") or 2000 # mA for all locks energised at the same time
+stagger_time = 0.1 # seconds between switching on two locks, spreads the inrush current
+
+opening = [] # compartments with an open operation in progress, advanced by update_all()
+batches = [] # OpenAll operations in progress
+
+# advance all open operations, called regularly by the scheduler. locks switched in the same call are written together
+def update_all():
+    locks.batched(update_operations)
+
+
+def update_operations():
+    for index in range(len(opening) - 1, -1, -1): # backwards, finished operations remove themselves
+        opening[index].update()
+    for index in range(len(batches) - 1, -1, -1):
+        batches[index].update()
+
+
+# open all compartments, several at once as long as the lock current stays within current_budget.
+# callback(failed) is called with the list of compartment indices that did not open
+class OpenAll():
+    def __init__(self, compartments, on_time=2, callback=None):
+        self.compartments = compartments
+        self.on_time = on_time
+        self.callback = callback
+        self.pending = [str(index + 1) for index in range(len(compartments))]
+        self.active = []
+        self.failed = []
+        self.current = 0 # mA of the active locks
+        self.next_start = 0
+        self.done = False
+        batches.append(self)
+
+    def lock_current(self, comp):
+        return len(comp.lock_outputs) * lock_current
+
+    # returns True when all compartments were opened (or failed to)
+    def update(self):
+        if self.done:
+            return True
+        for index in range(len(self.active) - 1, -1, -1):
+            comp = self.compartments[self.active[index]]
+            if not comp.is_opening():
+                self.current -= self.lock_current(comp)
+                if not comp.open_result:
+                    self.failed.append(self.active[index])
+                self.active.pop(index)
+        now = time.monotonic()
+        if len(self.pending) > 0 and now >= self.next_start:
+            comp = self.compartments[self.pending[0]]
+            needed = self.lock_current(comp)
+            if self.current == 0 or self.current + needed <= current_budget:
+                comp.start_open(self.on_time)
+                self.current += needed
+                self.active.append(self.pending.pop(0))
+                self.next_start = now + stagger_time
+        if len(self.pending) == 0 and len(self.active) == 0:
+            self.done = True
+            batches.remove(self)
+            if self.callback is not None:
+                self.callback(self.failed)
+        return self.done
+
+# compartment state store: one byte per compartment and state, index: compartment number. changes are persisted in the journal
+door_states = ("closed", "open", "error") # error: e.g. detected open without command
+content_states = ("unknown", "present", "empty") # unknown: default on boot
+door_state = bytearray(1)
+content_state = bytearray(1)
+
+
+# view on the state store and the IO of one compartment, door_status and content_status keep the string interface
 class compartment():
-    def __init__(self, input_pin, output_pin): # initialize with one IO pair
-        self.type = "small" # small, big (only one, set manually)
-        self.door_status = "closed" # closed, open, error (e.g. detected open without command)
-        self.content_status = "unknown" # present, empty, unknown (default on boot)
+    __slots__ = ("number", "type", "LED_connector", "LEDs", "lock_outputs", "open_deadline", "next_check", "open_callback", "open_result")
+
+    def __init__(self, number, expander_index, input_pin, output_pin): # initialize with one IO pair, pin numbers on the expander
+        self.number = number
+        self.type = "small" # small, big (more than one space, from the topology)
+        while len(door_state) <= number:
+            door_state.append(0)
+            content_state.append(0)
+        door_state[number] = 0
+        content_state[number] = 0
         self.LED_connector = None
         self.LEDs = None
-        self.status_inputs = []
-        self.lock_outputs = []
-        self.add_input(input_pin)
-        self.add_output(output_pin)
+        self.lock_outputs = () # (expander index, pin mask) pairs, switched through the locks module
+        self.open_deadline = None # time.monotonic() when the lock is switched off at the latest, None if not opening
+        self.next_check = 0
+        self.open_callback = None
+        self.open_result = None # door open after the last open operation
+        self.add_input(expander_index, input_pin)
+        self.add_output(expander_index, output_pin)
+
+    @property
+    def door_status(self):
+        return door_states[door_state[self.number]]
+
+    @door_status.setter
+    def door_status(self, status):
+        state = door_states.index(status)
+        if state != door_state[self.number]:
+            door_state[self.number] = state
+            journal.append(self.number, door_state, content_state)
 
-    # Setup input with a pull-up resistor enabled
-    def add_input(self, input_pin):
-        input_pin.direction = digitalio.Direction.INPUT
-        input_pin.pull = digitalio.Pull.UP
-        self.status_inputs.append(input_pin)
+    @property
+    def content_status(self):
+        return content_states[content_state[self.number]]
+
+    @content_status.setter
+    def content_status(self, status):
+        state = content_states.index(status)
+        if state != content_state[self.number]:
+            content_state[self.number] = state
+            journal.append(self.number, door_state, content_state)
+
+    # Setup input with a pull-up resistor enabled, door switches are read through the doors module
+    def add_input(self, expander_index, input_pin):
+        doors.add_input(self.number, expander_index, input_pin)
 
     # Setup output
-    def add_output(self, output_pin):
-        output_pin.direction = digitalio.Direction.OUTPUT
-        output_pin.value = False
-        self.lock_outputs.append(output_pin)
+    def add_output(self, expander_index, output_pin):
+        self.lock_outputs += ((expander_index, locks.add_output(expander_index, output_pin)),)
 
     def set_LEDs(self, color):
         for LED in self.LEDs:
             self.LED_connector[LED] = color
 
+    # read the door switches now, open if no switch is pressed (considered closed if one switch is pressed)
     def get_inputs(self):
-        open = True
-        for input in self.status_inputs:
-            if input.value == False: # count inputs which are low -> switch is pressed, door is closed (considered closed if one switch is pressed)
-                open = False
-        return open  # if sum > 0, door is closed
+        return doors.read_compartment(self.number)
 
+    # all lock outputs of the compartment in one write (per expander)
     def set_outputs(self, status):
-        for output in self.lock_outputs:
-            output.value = status
+        locks.set(self.lock_outputs, status)
+        locks.apply()
 
-    def open(self, on_time=2):
+    # start an open operation: energise the lock, update() switches it off when the door is open or on_time is over.
+    # callback(compartment, door_open) is called when finished
+    def start_open(self, on_time=2, callback=None):
         if on_time > maximum_on_time:
             on_time = maximum_on_time
-        counter = on_time / check_time
+        now = time.monotonic()
+        self.open_deadline = now + on_time
+        self.next_check = now + check_time
+        self.open_callback = callback
+        self.open_result = None
         self.set_outputs(True)
-        while counter > 0:
-            time.sleep(check_time)# TODO: non-blocking?
-            if self.get_inputs():
-                break
-            counter -= 1
-        self.set_outputs(False)
-        return self.get_inputs()
+        if self not in opening:
+            opening.append(self)
+
+    def is_opening(self):
+        return self.open_deadline is not None
+
+    # advance the open operation, returns None while it is in progress, else whether the door is open
+    def update(self):
+        if self.open_deadline is None:
+            return self.open_result
+        now = time.monotonic()
+        if now < self.next_check:
+            return None
+        self.next_check = now + check_time
+        if self.get_inputs() or now >= self.open_deadline:
+            self.set_outputs(False)
+            self.open_deadline = None
+            opening.remove(self)
+            self.open_result = self.get_inputs()
+            if self.open_callback is not None:
+                self.open_callback(self, self.open_result)
+            return self.open_result
+        return None
@@ -0,0 +1,188 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# door sensing with the MCP23017 interrupt-on-change, door open/close events with timestamps in a ring buffer, reported in batches
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import time
+import keypad
+from array import array
+
+from metrics import zeros
+from outbox import min_backoff, max_backoff
+
+door_pins = 0x5555 # even expander pins are door switch inputs (low: switch pressed, door closed), odd pins lock outputs
+IOCON_MIRROR = 0x40 # INTA and INTB both signal changes on either port
+IOCON_ODR = 0x04 # open drain interrupt outputs, the lines of all expanders can be wired together
+resync_interval = 5 # s, all expanders are read at least this often with the interrupt line, in case an edge was missed
+
+expanders = []
+irq = None # keypad.Keys on the shared INTA/INTB line, None: expanders are read on every check()
+irq_event = keypad.Event()
+state = array("H") # last GPIO value per expander
+pin_compartment = bytearray() # compartment number per expander pin (index: expander * 16 + pin), 0: no door switch
+compartment_inputs = {} # compartment number: (expander index, pin mask) pairs of its door switches
+door_open = bytearray() # last recorded door state per compartment number
+changes = array("H") # changed door pins per expander, reused by check()
+last_read = 0
+pending = False # interrupt seen, but the expanders were not read successfully yet
+
+# event ring buffer, preallocated. events are (time in ms since boot, compartment number, door open)
+capacity = 64
+event_times = zeros(capacity)
+event_compartments = bytearray(capacity)
+event_open = bytearray(capacity)
+first = 0 # index of the oldest event
+count = 0
+dropped = 0 # events overwritten before they were consumed
+
+# batched reporting of the events
+batch_size = 20
+max_delay = 60 # s, a batch is sent when it is full or its oldest event is this old
+backoff = 0
+next_attempt = 0
+
+
+# configure interrupt-on-change, enabled per door switch input by add_input(), irq: keypad.Keys on the (wired together) INTA/INTB lines or None
+def setup(port_expanders, irq_keys=None):
+    global irq, last_read, pending, state, pin_compartment, changes
+    expanders.clear()
+    state = array("H")
+    pin_compartment = bytearray()
+    changes = array("H")
+    compartment_inputs.clear()
+    for expander in port_expanders:
+        expander.interrupt_configuration = 0x0000 # compare against the previous value, not DEFVAL
+        expander.interrupt_enable = 0x0000 # unused inputs have no pull-up and float, they must not trigger interrupts
+        expander.io_control = expander.io_control | IOCON_MIRROR | IOCON_ODR
+        expanders.append(expander)
+        state.append(expander.gpio) # reading GPIO also clears pending interrupts
+        pin_compartment.extend(bytes(16))
+        changes.append(0)
+    irq = irq_keys
+    last_read = time.monotonic()
+    pending = False
+
+
+# configure pin of expander_index as door switch input with pull-up, registered for compartment number (int)
+def add_input(number, expander_index, pin):
+    mask = 1 << pin
+    expander = expanders[expander_index]
+    expander.iodir = expander.iodir | mask
+    expander.gppu = expander.gppu | mask
+    expander.interrupt_enable = expander.interrupt_enable | mask
+    state[expander_index] = expander.gpio
+    pin_compartment[expander_index * 16 + pin] = number
+    compartment_inputs[number] = compartment_inputs.get(number, ()) + ((expander_index, mask),)
+    while len(door_open) <= number:
+        door_open.append(0)
+    door_open[number] = int(is_open(number))
+
+
+# door open according to the last read, open if no switch of the compartment is pressed
+def is_open(number):
+    for expander_index, mask in compartment_inputs[number]:
+        if state[expander_index] & mask == 0:
+            return False
+    return True
+
+
+def record(number, opened):
+    global first, count, dropped
+    if count == capacity: # full, overwrite the oldest event
+        first = (first + 1) % capacity
+        count -= 1
+        dropped += 1
+    index = (first + count) % capacity
+    event_times[index] = time.monotonic_ns() // 1000000
+    event_compartments[index] = number
+    event_open[index] = int(opened)
+    count += 1
+
+
+# i-th oldest unconsumed event as (time in ms since boot, compartment number, door open)
+def event(i):
+    index = (first + i) % capacity
+    return event_times[index], event_compartments[index], event_open[index] == 1
+
+
+# remove the n oldest events, after they were processed
+def consume(n):
+    global first, count
+    n = min(n, count)
+    first = (first + n) % capacity
+    count -= n
+
+
+# read the expanders after an interrupt (or on every call without interrupt line) and record door transitions
+def check(logger=None):
+    global pending
+    now = time.monotonic()
+    if irq is not None:
+        while irq.events.get_into(irq_event):
+            pending = True
+        if not pending and now - last_read < resync_interval:
+            return
+    read(logger)
+
+
+# snapshot of all door switches, one GPIO read (both ports, one transaction) per expander. transitions since the last read are recorded
+def read(logger=None):
+    global last_read, pending
+    for expander_index, expander in enumerate(expanders): # read all first, a compartment can have switches on two expanders
+        value = expander.gpio # also clears the interrupt
+        changes[expander_index] = (value ^ state[expander_index]) & door_pins
+        state[expander_index] = value
+    last_read = time.monotonic()
+    pending = False # after the reads, a failed read is retried on the next check(), the interrupt is not signalled again
+    for expander_index in range(len(expanders)):
+        changed = changes[expander_index]
+        pin = 0
+        while changed:
+            if changed & 1:
+                number = pin_compartment[expander_index * 16 + pin]
+                opened = number != 0 and is_open(number)
+                if number != 0 and opened != door_open[number]:
+                    door_open[number] = int(opened)
+                    record(number, opened)
+                    if logger is not None:
+                        logger.info(f"Door of compartment {number} {'opened' if opened else 'closed'}.")
+            changed >>= 1
+            pin += 1
+
+
+# door of one compartment open, read now (one transaction per expander with a switch of the compartment)
+def read_compartment(number):
+    for expander_index, mask in compartment_inputs[number]:
+        if expanders[expander_index].gpio & mask == 0:
+            return False
+    return True
+
+
+# numbers of all compartments with open doors, from a fresh snapshot
+def open_compartments(logger=None):
+    read(logger)
+    return [number for number in compartment_inputs if door_open[number]]
+
+
+# send the oldest events in one batch when enough have collected (or waited long enough), called regularly from the main loop.
+# send(logger, events) gets a list of (time in ms since boot, compartment number, door open) and returns the status code
+def upload(logger, send):
+    global backoff, next_attempt
+    now = time.monotonic()
+    if count == 0 or now < next_attempt:
+        return 0
+    if count < batch_size and time.monotonic_ns() // 1000000 - event_times[first] < max_delay * 1000:
+        return 0
+    events = [event(i) for i in range(min(count, batch_size))]
+    status_code = send(logger, events)
+    if type(status_code) is int and 200 <= status_code < 300:
+        consume(len(events))
+        backoff = 0
+        next_attempt = 0
+        return len(events)
+    backoff = min(max(backoff * 2, min_backoff), max_backoff)
+    next_attempt = now + backoff
+    logger.warning(f"Uploading {len(events)} door events failed: {status_code}, retry in {backoff} s.")
+    return 0
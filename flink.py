@@ -3,23 +3,146 @@ import time
 import adafruit_logging as logging
 
 import networking
+from jsonstream import CodeStreamParser
+from outbox import Outbox
+from metrics import EndpointStats
 
 flink_timeout = 5
+chunk_size = 256  # bytes read from the socket at a time when streaming the codes
 
 ID = os.getenv("ID")
 flink_URL = os.getenv("FLINK_URL")
 flink_API_key = os.getenv("FLINK_API_KEY")
 
-def format_time():
-    t = time.localtime()
+def format_time(seconds=None):
+    t = time.localtime(seconds)
     return f"{t.tm_year}-{t.tm_mon:02}-{t.tm_mday:02}_{t.tm_hour:02}-{t.tm_min:02}-{t.tm_sec:02}"
 
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# circuit breaker for all Flink calls: after failure_threshold consecutive failures (no connection, timeout, 5xx)
+# the circuit opens and calls fail immediately. after probe_interval seconds a single call is let through (half open),
+# its result closes the circuit again or keeps it open for another probe_interval
+class CircuitBreaker():
+    def __init__(self, failure_threshold=3, probe_interval=60):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = "closed"  # closed, open, half_open
+        self.failures = 0
+        self.opened_at = 0
+        self.open_reported = False  # a call rejected by the open circuit was logged since it opened
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.probe_interval:
+            self.state = "half_open"
+            return True
+        return False  # open, or half open with the probe still running
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state == "closed":
+                self.open_reported = False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def is_closed(self):
+        return self.state == "closed"
+
+
+breaker = CircuitBreaker(os.getenv("FLINK_FAILURE_THRESHOLD") or 3, os.getenv("FLINK_PROBE_INTERVAL") or 60)
+rejected = False  # last status put was answered with 4xx, e.g. wrong API key or unknown ID. the breaker counts it as success
+request_count = 0  # requests sent to Flink, compare with networking.ssl_context.handshakes to see connection reuse
+
+# call statistics per endpoint, latency is measured until the response headers are received (codes: until the body is parsed)
+stats = {endpoint: EndpointStats(endpoint) for endpoint in ("status", "codes", "code_log", "error_log", "door_log")}
+
+
+def failure_type(e):
+    if isinstance(e, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(e, OSError):
+        if (e.args and e.args[0] in (110, 116)) or "timed out" in str(e):  # ETIMEDOUT (errno differs between ports)
+            return "timeout"
+        return "connection"
+    return "other"
+
+
+# summary of all endpoints for the status payload
+def stats_summary():
+    return {endpoint: endpoint_stats.summary() for endpoint, endpoint_stats in stats.items()}
+
+
+# log a failed call. calls rejected by the open circuit are logged once per outage, then at debug level,
+# so that an outage does not produce an error record (flash write, MQTT publish) on every attempt
+def log_failure(logger, message, e):
+    if isinstance(e, CircuitOpenError):
+        if breaker.open_reported:
+            logger.debug(f"{message}: {e}")
+        else:
+            breaker.open_reported = True
+            logger.warning(f"{message}: {e}, next attempt in {breaker.probe_interval} s")
+        return
+    logger.error(f"{message}: {e}")
+
+
+def log_stats(logger):
+    for endpoint_stats in stats.values():
+        logger.info(f"Flink {endpoint_stats}")
+
+
+# HTTP request to a Flink endpoint through the circuit breaker.
+# the response has to be closed (or read completely), only then the connection is reused for the next request
+# record_latency=False: the caller records the latency, e.g. after reading the body
+def request(method, endpoint, json=None, record_latency=True):
+    global request_count
+    endpoint_stats = stats[endpoint]
+    endpoint_stats.call()
+    if not breaker.allow():
+        endpoint_stats.fail("circuit_open")
+        raise CircuitOpenError("Flink unavailable, circuit open")
+    request_count += 1
+    start = time.monotonic_ns()
+    try:
+        response = networking.requests.request(
+            method,
+            f"{flink_URL}/{ID}/{endpoint}",
+            headers={"Authorization": flink_API_key},
+            json=json,
+            timeout=flink_timeout,
+        )
+    except Exception as e:
+        breaker.failure()
+        endpoint_stats.fail(failure_type(e))
+        raise
+    if record_latency:
+        endpoint_stats.record((time.monotonic_ns() - start) // 1000000)
+    if response.status_code >= 500:
+        breaker.failure()
+        endpoint_stats.fail("http_5xx")
+    else:
+        breaker.success()
+        if response.status_code >= 400:
+            endpoint_stats.fail("http_4xx")
+    return response
+
+
 # send status to Flink
 def put_status(logger, uptime, SN, version, comps, large_comps):
+    global rejected
     try:
-        response = networking.requests.put(
-            f"{flink_URL}/{ID}/status",
-            headers={"Authorization": flink_API_key},
+        response = request(
+            "PUT",
+            "status",
             json={
                 "time": format_time(),
                 "uptime": f"{uptime}",
@@ -27,68 +150,161 @@ def put_status(logger, uptime, SN, version, comps, large_comps):
                 "version": f"{version}",
                 "compartments": f"{comps}",
                 "large_compartments": f"{large_comps}",
+                "flink_requests": request_count,
+                "tls_handshakes": networking.ssl_context.handshakes,
+                "flink_stats": stats_summary(),
             },
-            timeout=flink_timeout,
         )
+        response.close()
+        rejected = 400 <= response.status_code < 500
         return response.status_code
     except Exception as e:
-        logger.error(f"Error putting status: {e}")
+        log_failure(logger, "Error putting status", e)
         return e
 
 
-# get codes from Flink
-def get_codes(logger):
+# get codes from Flink. the response is parsed while it is received, callback(compartment, code, valid_from, valid_until)
+# is called for every code. returns the status code and the number of codes
+def get_codes(logger, callback):
+    start = time.monotonic_ns()
     try:
-        response = networking.requests.get(
-            f"{flink_URL}/{ID}/codes",
-            headers={"Authorization": flink_API_key},
-            timeout=flink_timeout,
-        )
-        return response.status_code, response.json()
+        response = request("GET", "codes", record_latency=False)
+        try:
+            if response.status_code != 200:
+                return response.status_code, None
+            parser = CodeStreamParser(callback)
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    parser.feed(chunk)
+            except OSError as e:  # connection lost while receiving
+                breaker.failure()
+                stats["codes"].fail(failure_type(e))
+                raise
+            return response.status_code, parser.close()
+        finally:
+            response.close()
+            stats["codes"].record((time.monotonic_ns() - start) // 1000000)  # including streaming and parsing the body
     except Exception as e:
-        logger.error(f"Error getting codes: {e}")
+        log_failure(logger, "Error getting codes", e)
         return e, None
 
 
-def post_code_log(logger, code, compartments, compartment_index):
+# code log entry, created when the code was entered
+def code_log_entry(code, compartments, compartment_index):
     if (compartment_index is not None) and (compartment_index in compartments):
         content = compartments[compartment_index].content_status
         door = compartments[compartment_index].door_status
     else:
         content = None
         door = None
+    return {
+        "time": format_time(),
+        "code_entered": f"{code}",
+        "compartment": f"{compartment_index}",
+        "content": content,
+        "door": door,
+    }
+
+
+# post a batch of code log entries (JSON list) to Flink
+def post_code_log(logger, entries):
     try:
-        response = networking.requests.post(
-            f"{flink_URL}/{ID}/code_log",
-            headers={"Authorization": flink_API_key},
-            json={
-                "time": format_time(),
-                "code_entered": f"{code}",
-                "compartment": f"{compartment_index}",
-                "content": content,
-                "door": door,
-            },
-            timeout=flink_timeout,
-        )
+        response = request("POST", "code_log", json=entries)
+        response.close()
         return response.status_code
     except Exception as e:
-        logger.error(f"Error posting code log: {e}")
+        log_failure(logger, "Error posting code log", e)
         return e
 
 
+# code log entries are queued on flash and uploaded in batches by flush_code_log(), no network wait after a transaction
+code_log_outbox = Outbox("/code_log.jsonl", post_code_log)
+
+
+def queue_code_log(logger, code, compartments, compartment_index):
+    code_log_outbox.append(code_log_entry(code, compartments, compartment_index), logger)
+
+
+# upload queued code log entries, called regularly from the main loop
+def flush_code_log(logger):
+    return code_log_outbox.flush(logger)
+
+
+# door events from doors.upload(), (time in ms since boot, compartment number, door open), sent as one list
+def post_door_log(logger, events):
+    now_ms = time.monotonic_ns() // 1000000
+    now = time.time()
+    entries = []
+    for event_ms, compartment_number, door_open in events:
+        entries.append({
+            "time": format_time(now - (now_ms - event_ms) // 1000),
+            "uptime_ms": event_ms,
+            "compartment": f"{compartment_number}",
+            "door": "open" if door_open else "closed",
+        })
+    try:
+        response = request("POST", "door_log", json=entries)
+        response.close()
+        return response.status_code
+    except Exception as e:
+        log_failure(logger, "Error posting door log", e)
+        return e
+
+
+# error log handler: records are only queued in emit(), identical messages are counted instead of queued again.
+# upload() sends them in batches, at most batch_size records every min_interval seconds
 class FlinkLogHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET, max_entries=20, batch_size=10, min_interval=60):
+        super().__init__(level)
+        self.entries = []  # pending records as dicts, "count" is the number of identical messages
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.dropped = 0  # records dropped because the queue was full
+        self.last_upload = None
+
     def emit(self, record):
+        message = f"{record.msg}"
+        for entry in self.entries:
+            if entry["message"] == message and entry["level"] == record.levelname:
+                entry["count"] += 1
+                entry["last_uptime"] = f"{record.created}"
+                return
+        if len(self.entries) >= self.max_entries:
+            self.dropped += 1
+            return
+        self.entries.append({
+            "time": format_time(),
+            "uptime": f"{record.created}",
+            "level": f"{record.levelname}",
+            "message": message,
+            "count": 1,
+            "last_uptime": f"{record.created}",
+        })
+
+    # send the next batch of records if the rate limit allows, returns the number of records sent.
+    # errors are not logged, they would be queued again
+    def upload(self):
+        if len(self.entries) == 0 and self.dropped == 0:
+            return 0
+        now = time.monotonic()
+        if self.last_upload is not None and now - self.last_upload < self.min_interval:
+            return 0
+        self.last_upload = now
+        count = min(len(self.entries), self.batch_size)
+        batch = self.entries[:count]
+        dropped = self.dropped
+        if dropped > 0:
+            batch = batch + [{"time": format_time(), "uptime": f"{now}", "level": "WARNING", "message": f"{dropped} log records dropped, queue full.", "count": 1, "last_uptime": f"{now}"}]
         try:
-            response = networking.requests.post(
-                f"{flink_URL}/{ID}/error_log",
-                headers={"Authorization": flink_API_key},
-                json={
-                    "time": format_time(),
-                    "uptime": f"{record.created}",
-                    "level": f"{record.levelname}",
-                    "message": f"{record.msg}",
-                },
-                timeout=flink_timeout,
-            )
-        except Exception:  # ignore, otherwise we will get another error while logging
-            pass
+            response = request("POST", "error_log", json=batch)
+            response.close()
+            status_code = response.status_code
+        except Exception as e:  # ignore, otherwise we will get another error while logging
+            print(e)
+            return 0
+        if 200 <= status_code < 300:
+            self.entries = self.entries[count:]
+            self.dropped -= dropped
+            return len(batch)
+        return 0
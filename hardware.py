@@ -2,8 +2,11 @@
 # Schlüsselkasten Hardware SETUP
 #
 
+import os
+import time
 import busio
 import board
+import keypad
 import pwmio
 import digitalio
 import neopixel
@@ -72,6 +75,17 @@ except Exception as e:
     touch_sensor = None
     #TODO: logger.error(f"Error setting up touch sensor: {e}")
 
+# MPR121 IRQ output (open drain, low while a touch status change is unread), board pin name from settings, e.g. "D9"
+# without it, the touch status is polled over I2C on every read_keypad() call
+touch_irq = None
+touch_irq_pin = os.getenv("TOUCH_IRQ_PIN")
+if touch_sensor is not None and touch_irq_pin:
+    try:
+        touch_irq = keypad.Keys((getattr(board, touch_irq_pin),), value_when_pressed=False, pull=True)
+    except Exception as e:
+        touch_irq = None
+        #TODO: logger.error(f"Error setting up touch interrupt: {e}")
+
 # also on the bus at 0x38: touch screen controller FT6206
 
 # get connected port expanders (adresses from 0x20 to 0x27, prototype PCBs: 0x24 to 0x27)
@@ -82,10 +96,42 @@ for addr in range(0x20, 0x28):
     except: # ValueError if device does not exist, ignore
         pass
 
+# MCP23017 INTA/INTB outputs (mirrored, open drain, wired together), board pin name from settings, e.g. "D6"
+# without it, the door switches are read on every door check
+door_irq = None
+door_irq_pin = os.getenv("DOOR_IRQ_PIN")
+if len(port_expanders) > 0 and door_irq_pin:
+    try:
+        door_irq = keypad.Keys((getattr(board, door_irq_pin),), value_when_pressed=False, pull=True)
+    except Exception as e:
+        door_irq = None
+        #TODO: logger.error(f"Error setting up door interrupt: {e}")
+
 
 keys = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "x", "0", "✓"]
-# read touch pads with MPR121
+touch_resync = 1  # s, status is read at least this often with the interrupt, in case an edge was missed
+touch_event = keypad.Event()  # reused, no allocation per event
+last_key = None
+last_touch_read = 0
+
+
+# read touch pads with MPR121, with the interrupt line only when it signals a change
 def read_keypad():
+    global last_key, last_touch_read
+    if touch_irq is not None:
+        changed = False
+        while touch_irq.events.get_into(touch_event):  # edges of the IRQ line, queued in the background
+            changed = True
+        now = time.monotonic()
+        if not changed and now - last_touch_read < touch_resync:
+            return last_key
+        last_touch_read = now
+        last_key = read_touched()  # reading the status clears the IRQ
+        return last_key
+    return read_touched()
+
+
+def read_touched():
     touched_list = []
     if touch_sensor is not None:
         touched = touch_sensor.touched()
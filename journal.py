@@ -0,0 +1,91 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# persistent compartment state: append-only journal in microcontroller.nvm, replayed at boot, compacted when full
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import microcontroller
+
+# layout: 4 byte header, then 4 byte records (compartment number, door state, content state, check), unused records are 0xFF.
+# records are appended through the whole region before it is rewritten, so every byte is written about once per cycle
+magic = b"ZJ\x01\x00"
+record_size = 4
+region_size = 1024 # bytes at the start of the nvm
+empty = 0xFF
+
+nvm = microcontroller.nvm # None on boards without nvm, the journal is disabled
+if nvm is not None:
+    region_size = min(region_size, len(nvm))
+position = len(magic) # offset of the next record
+record_buffer = bytearray(record_size)
+
+
+def check_byte(number, door, content):
+    return number ^ (door | content << 4) ^ 0x5A
+
+
+# replay the journal into the state arrays (index: compartment number), returns the number of records applied
+def load(door_state, content_state, logger=None):
+    global position
+    if nvm is None:
+        return 0
+    region = nvm[0:region_size]
+    if region[0:len(magic)] != magic:
+        if logger is not None:
+            logger.info("No compartment state journal found, starting a new one.")
+        compact(b"", b"")
+        return 0
+    applied = 0
+    position = len(magic)
+    while position + record_size <= region_size:
+        number, door, content, check = region[position], region[position + 1], region[position + 2], region[position + 3]
+        if number == empty:
+            break
+        if check != check_byte(number, door, content): # torn write, the next record overwrites it
+            if logger is not None:
+                logger.warning(f"Compartment state journal damaged at byte {position}, {applied} records replayed.")
+            break
+        if number < len(door_state):
+            door_state[number] = door
+            content_state[number] = content
+            applied += 1
+        position += record_size
+    return applied
+
+
+# persist the state of one compartment, compacts the journal to the current states when it is full
+def append(number, door_state, content_state):
+    if nvm is None:
+        return
+    if position + record_size > region_size:
+        compact(door_state, content_state)
+        return
+    write(position, number, door_state[number], content_state[number])
+
+
+def write(offset, number, door, content):
+    global position
+    record_buffer[0] = number
+    record_buffer[1] = door
+    record_buffer[2] = content
+    record_buffer[3] = check_byte(number, door, content)
+    nvm[offset:offset + record_size] = record_buffer
+    position = offset + record_size
+
+
+# rewrite the region with one record per compartment that is not in the default state, in one nvm write
+def compact(door_state, content_state):
+    global position
+    region = bytearray(region_size)
+    for index in range(region_size):
+        region[index] = empty
+    region[0:len(magic)] = magic
+    offset = len(magic)
+    for number in range(1, len(door_state)):
+        door, content = door_state[number], content_state[number]
+        if (door != 0 or content != 0) and offset + record_size <= region_size:
+            region[offset:offset + record_size] = bytes((number, door, content, check_byte(number, door, content)))
+            offset += record_size
+    nvm[0:region_size] = region
+    position = offset
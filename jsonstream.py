@@ -0,0 +1,161 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# incremental parser for the codes JSON from Flink, to avoid building the full object tree in RAM
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# expected document: {"<compartment>": ["<code>", {"code": "<code>", "valid_from": <time>, "valid_until": <time>}, ...], ...}
+# the parser is fed chunks of bytes and calls callback(compartment, code, valid_from, valid_until) for every code.
+# memory use is bounded by the longest string/number (max_token) and the nesting depth, not by the document size.
+# containers deeper than max_depth (e.g. extra fields in a code object) are skipped up to their closing bracket
+
+OBJECT = 0x7B  # {
+ARRAY = 0x5B  # [
+QUOTE = 0x22  # "
+BACKSLASH = 0x5C
+WHITESPACE = b" \t\r\n"
+ESCAPES = {0x6E: 0x0A, 0x74: 0x09, 0x72: 0x0D, 0x62: 0x08, 0x66: 0x0C}  # \n \t \r \b \f, others map to themselves
+
+max_depth = 3  # object of compartments -> list of codes -> code object
+
+
+class CodeStreamParser():
+    def __init__(self, callback, max_token=64):
+        self.callback = callback
+        self.max_token = max_token
+        self.stack = bytearray()  # open containers, OBJECT or ARRAY
+        self.skip = 0  # depth of skipped containers, their content is ignored
+        self.token = bytearray()  # current string or number
+        self.in_string = False
+        self.in_scalar = False
+        self.escape = False
+        self.expect_key = False
+        self.compartment = None  # current key of the top level object
+        self.field = None  # current key of a code object
+        self.code = None
+        self.valid_from = None
+        self.valid_until = None
+        self.count = 0  # codes emitted
+
+    def feed(self, chunk):
+        i = 0
+        length = len(chunk)
+        while i < length:
+            c = chunk[i]
+            if self.in_string:
+                if self.escape:
+                    if self.skip == 0:
+                        self.add(ESCAPES.get(c, c))
+                    self.escape = False
+                elif c == QUOTE:
+                    self.in_string = False
+                    self.value(str(self.token, "utf-8"))
+                elif c == BACKSLASH:
+                    self.escape = True
+                else:
+                    end = i + 1  # copy up to the next quote or backslash in one go
+                    while end < length and chunk[end] != QUOTE and chunk[end] != BACKSLASH:
+                        end += 1
+                    if self.skip == 0:
+                        if len(self.token) + end - i > self.max_token:
+                            raise ValueError("string too long")
+                        self.token += chunk[i:end]
+                    i = end
+                    continue
+                i += 1
+                continue
+            if self.in_scalar:
+                if c in WHITESPACE or c == 0x2C or c == 0x5D or c == 0x7D:  # , ] } end a number/literal
+                    self.in_scalar = False
+                    if self.skip == 0:
+                        self.value(self.scalar(str(self.token, "utf-8")))
+                else:
+                    if self.skip == 0:
+                        self.add(c)
+                    i += 1
+                    continue
+            if c in WHITESPACE:
+                pass
+            elif c == QUOTE:
+                self.token = bytearray()
+                self.in_string = True
+            elif self.skip > 0:  # inside a skipped container, only its brackets are counted
+                if c == OBJECT or c == ARRAY:
+                    self.skip += 1
+                elif c == 0x7D or c == 0x5D:  # } ]
+                    self.skip -= 1
+                elif c != 0x3A and c != 0x2C:  # number or literal
+                    self.in_scalar = True
+            elif c == OBJECT or c == ARRAY:
+                if len(self.stack) >= max_depth:  # unknown nested value, e.g. an additional field of a code object
+                    self.skip = 1
+                    i += 1
+                    continue
+                self.stack.append(c)
+                self.expect_key = c == OBJECT
+                if len(self.stack) == 3:
+                    self.code = self.valid_from = self.valid_until = None
+            elif c == 0x7D or c == 0x5D:  # } ]
+                if len(self.stack) == 0:
+                    raise ValueError("unexpected end of container")
+                if len(self.stack) == 3 and self.code is not None:  # end of a code object
+                    self.emit(self.code, self.valid_from, self.valid_until)
+                self.stack.pop()
+                self.expect_key = False
+            elif c == 0x3A:  # :
+                self.expect_key = False
+            elif c == 0x2C:  # ,
+                self.expect_key = len(self.stack) > 0 and self.stack[-1] == OBJECT
+            else:
+                self.token = bytearray((c,))
+                self.in_scalar = True
+            i += 1
+
+    # end of the document, finishes a trailing number
+    def close(self):
+        if self.in_scalar:
+            self.in_scalar = False
+            self.value(self.scalar(str(self.token, "utf-8")))
+        if self.in_string or len(self.stack) != 0 or self.skip != 0:
+            raise ValueError("incomplete document")
+        return self.count
+
+    def add(self, c):
+        if len(self.token) >= self.max_token:
+            raise ValueError("token too long")
+        self.token.append(c)
+
+    def scalar(self, text):
+        if text == "null":
+            return None
+        if text == "true" or text == "false":
+            return text == "true"
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+
+    # a complete string or number was read, interpret it by its position in the document
+    def value(self, value):
+        if self.skip > 0:
+            return
+        depth = len(self.stack)
+        if self.expect_key:
+            if depth == 1:
+                self.compartment = value
+            elif depth == 3:
+                self.field = value
+        elif depth == 2:  # plain code in the list of a compartment
+            self.emit(value, None, None)
+        elif depth == 3:
+            if self.field == "code":
+                self.code = value
+            elif self.field == "valid_from":
+                self.valid_from = value
+            elif self.field == "valid_until":
+                self.valid_until = value
+
+    def emit(self, code, valid_from, valid_until):
+        self.count += 1
+        self.callback(self.compartment, code, valid_from, valid_until)
@@ -0,0 +1,64 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# lock outputs: shadow of the MCP23017 output latches, any set of lock changes is written with one transaction per expander
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from array import array
+
+expanders = []
+shadow = array("H") # output latch value per expander, as last written (or to be written)
+dirty = bytearray() # expanders with changes not written yet
+batch = False # while True, apply() does nothing, changes are collected until the batch is applied
+
+
+# all outputs off, the latches may still be set from before a soft reset
+def setup(port_expanders):
+    global shadow, dirty
+    expanders.clear()
+    shadow = array("H")
+    dirty = bytearray()
+    for expander in port_expanders:
+        expanders.append(expander)
+        shadow.append(0)
+        dirty.append(0)
+        expander.gpio = 0x0000 # writes OLATA and OLATB, input pins are not affected
+
+
+# configure pin of expander_index as lock output (off), returns the pin mask
+def add_output(expander_index, pin):
+    mask = 1 << pin
+    expander = expanders[expander_index]
+    expander.iodir = expander.iodir & ~mask & 0xFFFF
+    return mask
+
+
+# change outputs in the shadow, outputs: list of (expander index, pin mask)
+def set(outputs, status):
+    for expander_index, mask in outputs:
+        value = shadow[expander_index] | mask if status else shadow[expander_index] & ~mask & 0xFFFF
+        if value != shadow[expander_index]:
+            shadow[expander_index] = value
+            dirty[expander_index] = 1
+
+
+# write the changed expanders, one 16 bit write (both ports) each
+def apply():
+    if batch:
+        return
+    for expander_index in range(len(expanders)):
+        if dirty[expander_index]:
+            expanders[expander_index].gpio = shadow[expander_index]
+            dirty[expander_index] = 0
+
+
+# collect all lock changes made by function and write them together
+def batched(function):
+    global batch
+    batch = True
+    try:
+        function()
+    finally:
+        batch = False
+        apply()
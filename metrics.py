@@ -0,0 +1,70 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# lightweight call statistics: counters and a fixed bucket latency histogram in preallocated arrays
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from array import array
+
+latency_buckets = (50, 100, 250, 500, 1000, 2500, 5000)  # upper bounds in ms, one more bucket for everything above
+failure_types = ("timeout", "connection", "http_4xx", "http_5xx", "circuit_open", "other")
+
+
+def zeros(length, value=0):
+    values = array("L")
+    for _ in range(length):
+        values.append(value)
+    return values
+
+
+# statistics of one endpoint, recording a call does not allocate
+class EndpointStats():
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0  # every attempt, also those that failed without a response
+        self.responses = 0
+        self.failures = zeros(len(failure_types))
+        self.histogram = zeros(len(latency_buckets) + 1)
+        self.total_ms = 0
+        self.max_ms = 0
+
+    # a call is attempted
+    def call(self):
+        self.calls += 1
+
+    # a call got a response (any status code), latency_ms until it was complete
+    def record(self, latency_ms):
+        self.responses += 1
+        self.total_ms += latency_ms
+        if latency_ms > self.max_ms:
+            self.max_ms = latency_ms
+        bucket = 0
+        while bucket < len(latency_buckets) and latency_ms > latency_buckets[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    # a failed call, failure_type is one of failure_types. failures with a response are also recorded with record()
+    def fail(self, failure_type):
+        self.failures[failure_types.index(failure_type)] += 1
+
+    def mean_ms(self):
+        if self.responses == 0:
+            return 0
+        return self.total_ms // self.responses
+
+    # dict for the status payload
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "responses": self.responses,
+            "mean_ms": self.mean_ms(),
+            "max_ms": self.max_ms,
+            "histogram": list(self.histogram),
+            "failures": {name: self.failures[index] for index, name in enumerate(failure_types) if self.failures[index] > 0},
+        }
+
+    # one line for the logger
+    def __str__(self):
+        failures = ", ".join(f"{name}: {self.failures[index]}" for index, name in enumerate(failure_types) if self.failures[index] > 0)
+        return f"{self.name}: {self.calls} calls, {self.responses} responses, mean {self.mean_ms()} ms, max {self.max_ms} ms, histogram {list(self.histogram)} (ms bounds {latency_buckets}), failures: {failures or 'none'}"
@@ -1,5 +1,6 @@
 import os
 import ssl
+import time
 import wifi
 import socketpool
 import adafruit_requests
@@ -7,19 +8,55 @@ import ipaddress
 import rtc
 import adafruit_ntp
 
+# counts TLS handshakes (one per new TLS connection), reused keep-alive connections do not wrap a new socket
+class CountingSSLContext():
+    def __init__(self, context):
+        self.context = context
+        self.handshakes = 0
+        self.handshakes_by_host = {}
+
+    def wrap_socket(self, sock, server_hostname=None, **kwargs):
+        self.handshakes += 1
+        self.handshakes_by_host[server_hostname] = self.handshakes_by_host.get(server_hostname, 0) + 1
+        return self.context.wrap_socket(sock, server_hostname=server_hostname, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+# one socket pool and one SSL context shared by HTTP (Flink) and MQTT (Adafruit IO)
 pool = socketpool.SocketPool(wifi.radio)
+ssl_context = CountingSSLContext(ssl.create_default_context())
 
-requests = adafruit_requests.Session(pool, ssl.create_default_context())
+# the session keeps connections open (HTTP/1.1 keep-alive) and reuses them once a response was closed
+requests = adafruit_requests.Session(pool, ssl_context)
 
 wifi_ssid = os.getenv("CIRCUITPY_WIFI_SSID")
 wifi_pw = os.getenv("CIRCUITPY_WIFI_PASSWORD")
 
+reconnect_interval = 30  # s between reconnect attempts from the main loop
+reconnect_timeout = 5  # s, longest a reconnect attempt blocks the main loop
+last_reconnect = None
+
 # connects to wifi if currently not connected
 def connect_wifi():
     if not wifi.radio.connected:
         wifi.radio.connect(wifi_ssid, wifi_pw)
     return wifi.radio.connected
 
+# reconnect from the main loop: at most every reconnect_interval, and with a timeout, so a missing access point
+# does not block keypad handling for the full connect time on every check
+def reconnect_wifi():
+    global last_reconnect
+    if wifi.radio.connected:
+        return True
+    now = time.monotonic()
+    if last_reconnect is not None and now - last_reconnect < reconnect_interval:
+        return False
+    last_reconnect = now
+    wifi.radio.connect(wifi_ssid, wifi_pw, timeout=reconnect_timeout)
+    return wifi.radio.connected
+
 # gets time (UTC) from NTP
 def get_time():
     ntp = adafruit_ntp.NTP(pool, tz_offset=0)
@@ -0,0 +1,111 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# persistent outbox: entries are appended to a file on flash and sent to Flink in batches by a background task
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import time
+import json
+
+min_backoff = 10  # seconds to wait after the first failed upload, doubled for every further failure
+max_backoff = 600
+
+
+# one JSON entry per line in the queue file, the number of bytes already sent is stored in a second file.
+# if the filesystem is not writable (USB connected), entries are kept in RAM instead
+class Outbox():
+    def __init__(self, path, send, batch_size=20, max_ram_entries=50):
+        self.path = path
+        self.pos_path = path + ".pos"
+        self.send = send  # send(logger, entries) -> status code
+        self.batch_size = batch_size
+        self.max_ram_entries = max_ram_entries
+        self.persistent = True
+        self.ram_entries = []
+        self.sent = self.read_pos()  # bytes of the queue file already sent
+        self.backoff = 0
+        self.next_attempt = 0
+
+    def read_pos(self):
+        try:
+            with open(self.pos_path, "r") as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return 0
+
+    # add an entry, never blocks on the network
+    def append(self, entry, logger):
+        if self.persistent:
+            try:
+                with open(self.path, "a") as file:
+                    file.write(json.dumps(entry) + "\n")
+                return
+            except OSError as e:  # filesystem read-only, does not change until reset
+                logger.warning(f"Outbox {self.path} not writable, queueing in RAM: {e}")
+                self.persistent = False
+        if len(self.ram_entries) >= self.max_ram_entries:
+            self.ram_entries.pop(0)
+            logger.warning(f"Outbox {self.path} full, oldest entry dropped.")
+        self.ram_entries.append(entry)
+
+    # read the next batch from the queue file, returns the entries and the new sent position
+    def read_batch(self):
+        entries = []
+        pos = self.sent
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(pos)
+                while len(entries) < self.batch_size:
+                    line = file.readline()
+                    if not line.endswith(b"\n"):  # end of file or entry still being written
+                        break
+                    pos += len(line)
+                    try:
+                        entries.append(json.loads(str(line, "utf-8")))
+                    except ValueError:  # corrupted line, e.g. after power loss, skip it
+                        pass
+        except OSError:  # no queue file
+            pass
+        return entries, pos
+
+    def mark_sent(self, pos):
+        self.sent = pos
+        try:
+            if os.stat(self.path)[6] <= pos:  # everything sent, start over
+                os.remove(self.path)
+                os.remove(self.pos_path)
+                self.sent = 0
+            else:
+                with open(self.pos_path, "w") as file:
+                    file.write(str(pos))
+        except OSError:
+            pass
+
+    # send one batch if the backoff time has passed, returns the number of entries sent
+    def flush(self, logger):
+        if time.monotonic() < self.next_attempt:
+            return 0
+        from_file = True
+        entries, pos = self.read_batch()
+        if len(entries) == 0 and pos == self.sent:
+            from_file = False
+            entries = self.ram_entries[:self.batch_size]
+        if len(entries) == 0:
+            if pos != self.sent:  # only corrupted lines
+                self.mark_sent(pos)
+            return 0
+        status_code = self.send(logger, entries)
+        if type(status_code) is int and 200 <= status_code < 300:
+            if from_file:
+                self.mark_sent(pos)
+            else:
+                self.ram_entries = self.ram_entries[len(entries):]
+            self.backoff = 0
+            self.next_attempt = 0
+            return len(entries)
+        self.backoff = min(max(self.backoff * 2, min_backoff), max_backoff)
+        self.next_attempt = time.monotonic() + self.backoff
+        logger.warning(f"Uploading {len(entries)} entries from {self.path} failed: {status_code}, retry in {self.backoff} s.")
+        return 0
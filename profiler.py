@@ -0,0 +1,59 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# main loop stage profiler: min/max/mean duration per stage in preallocated arrays, cheap enough to stay enabled
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from adafruit_ticks import ticks_ms, ticks_diff
+
+from metrics import zeros
+
+max_total = 0xFFFFFFFF  # total_ms is an unsigned 32 bit array, halved (with count) before it overflows
+
+
+# usage: start = profiler.start(); ... stage ...; profiler.stop(stage_index, start)
+# millisecond ticks are small ints, time.monotonic_ns() would allocate a long int on every call
+class StageProfiler():
+    def __init__(self, names):
+        self.names = names
+        self.count = zeros(len(names))
+        self.total_ms = zeros(len(names))
+        self.min_ms = zeros(len(names), max_total)
+        self.max_ms = zeros(len(names))
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def start(self):
+        return ticks_ms()
+
+    def stop(self, stage, start):
+        duration = ticks_diff(ticks_ms(), start)
+        if self.total_ms[stage] > max_total - duration:
+            self.total_ms[stage] //= 2
+            self.count[stage] //= 2
+        self.total_ms[stage] += duration
+        self.count[stage] += 1
+        if duration < self.min_ms[stage]:
+            self.min_ms[stage] = duration
+        if duration > self.max_ms[stage]:
+            self.max_ms[stage] = duration
+
+    def reset(self):
+        for stage in range(len(self.names)):
+            self.count[stage] = 0
+            self.total_ms[stage] = 0
+            self.min_ms[stage] = max_total
+            self.max_ms[stage] = 0
+
+    # one line per stage: count, min/mean/max in ms
+    def snapshot(self):
+        lines = []
+        for stage, name in enumerate(self.names):
+            count = self.count[stage]
+            if count == 0:
+                lines.append(f"{name}: no runs")
+                continue
+            lines.append(f"{name}: {count} runs, min {self.min_ms[stage]} ms, mean {self.total_ms[stage] / count:.1f} ms, max {self.max_ms[stage]} ms")
+        return "\n".join(lines)
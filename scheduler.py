@@ -0,0 +1,98 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# deadline based periodic jobs for the asyncio main loop, with jitter and overrun statistics
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+
+SKIP = "skip"  # missed runs are dropped, only one overdue run is executed, then the job continues on its schedule
+CATCH_UP = "catch_up"  # missed runs are executed back to back, at most max_catch_up of them
+
+
+# a job runs at start + n * period, independent of how long its runs (or the other jobs) take.
+# times are millisecond ticks (small ints), time.monotonic_ns() would allocate a long int on every run
+class PeriodicJob():
+    def __init__(self, name, function, period, delay=0, policy=SKIP, max_catch_up=3):
+        self.name = name
+        self.function = function
+        self.period_ms = int(period * 1000)
+        self.delay_ms = int(delay * 1000)
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.next_run = 0  # deadline of the next run, ticks_ms()
+        self.runs = 0
+        self.overruns = 0  # runs that took longer than the period
+        self.missed = 0  # deadlines skipped
+        self.jitter_total_ms = 0  # sum of run start minus deadline
+        self.jitter_max_ms = 0
+        self.duration_max_ms = 0
+        self.errors = 0  # runs that raised an exception
+        self.last_error = None  # message of the last exception, repeats are not logged again
+        self.logger = None  # set by run_all(), print() without
+
+    async def run(self):
+        self.next_run = ticks_add(ticks_ms(), self.delay_ms)
+        while True:
+            wait = ticks_diff(self.next_run, ticks_ms())
+            if wait > 0:
+                await asyncio.sleep_ms(wait)
+            else:
+                await asyncio.sleep(0)  # let the other jobs run
+            self.run_once()
+
+    def run_once(self):
+        start = ticks_ms()
+        jitter = ticks_diff(start, self.next_run)
+        if jitter > self.jitter_max_ms:
+            self.jitter_max_ms = jitter
+        self.jitter_total_ms += jitter
+        try:
+            self.function()
+        except Exception as e:  # a failing job must not end asyncio.run() and with it all other jobs
+            self.error(e)
+        duration = ticks_diff(ticks_ms(), start)
+        self.runs += 1
+        if duration > self.duration_max_ms:
+            self.duration_max_ms = duration
+        if duration > self.period_ms:
+            self.overruns += 1
+        self.next_run = ticks_add(self.next_run, self.period_ms)
+        overdue = ticks_diff(ticks_ms(), self.next_run)
+        if overdue >= 0:  # deadlines passed while running or waiting for other jobs
+            late = overdue // self.period_ms + 1
+            allowed = self.max_catch_up if self.policy == CATCH_UP else 1  # overdue runs still executed
+            if late > allowed:
+                self.missed += late - allowed
+                self.next_run = ticks_add(self.next_run, (late - allowed) * self.period_ms)
+
+    def error(self, e):
+        self.errors += 1
+        message = f"{type(e).__name__}: {e}"
+        if message == self.last_error:
+            return
+        self.last_error = message
+        message = f"Error in job {self.name} ({self.errors} errors): {message}"
+        if self.logger is not None:
+            self.logger.error(message)
+        else:
+            print(message)
+
+    def mean_jitter_ms(self):
+        if self.runs == 0:
+            return 0
+        return self.jitter_total_ms // self.runs
+
+    def __str__(self):
+        return (f"{self.name}: {self.runs} runs, period {self.period_ms} ms, jitter mean {self.mean_jitter_ms()} ms"
+                f" max {self.jitter_max_ms} ms, longest run {self.duration_max_ms} ms,"
+                f" {self.overruns} overruns, {self.missed} missed, {self.errors} errors")
+
+
+async def run_all(jobs, logger=None):
+    for job in jobs:
+        job.logger = logger
+    tasks = [asyncio.create_task(job.run()) for job in jobs]
+    await asyncio.gather(*tasks)
@@ -0,0 +1,80 @@
+# memory and lookup benchmark: valid_codes dict (as returned by response.json()) vs. compact CodeTable
+# runs on the device (copy next to codetable.py) or on a PC: python3 testing/code_table_benchmark.py
+
+import gc
+import sys
+import time
+import random
+
+try:
+    import tracemalloc  # PC
+except ImportError:  # CircuitPython
+    tracemalloc = None
+
+sys.path.append("..")
+sys.path.append(".")
+from codetable import CodeTable
+
+compartments = 32
+
+
+def mem_used():
+    gc.collect()
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return gc.mem_alloc()
+
+
+def ticks():
+    return time.monotonic_ns()
+
+
+def make_codes(number):
+    return [random.randint(0, 9999) for _ in range(number)]
+
+
+def bench_dict(code_list):
+    before = mem_used()
+    valid_codes = {}
+    for index, code in enumerate(code_list):
+        comp = str(index % compartments + 1)
+        if comp not in valid_codes:
+            valid_codes[comp] = []
+        valid_codes[comp].append(f"{code:04}")  # new string object, like the JSON parser creates
+    used = mem_used() - before
+    start = ticks()
+    for code in code_list[:100]:
+        code = f"{code:04}"
+        for comp, comp_codes in valid_codes.items():
+            if code in comp_codes:
+                break
+    lookup_time = (ticks() - start) / 100
+    return used, lookup_time
+
+
+def bench_table(code_list):
+    before = mem_used()
+    table = CodeTable(len(code_list))
+    for index, code in enumerate(code_list):
+        table.add(code, index % compartments + 1, 0, 0, 0)
+    table.sort()
+    used = mem_used() - before
+    start = ticks()
+    for code in code_list[:100]:
+        table.first(code)
+    lookup_time = (ticks() - start) / 100
+    return used, lookup_time
+
+
+if tracemalloc is not None:
+    tracemalloc.start()
+
+for number in (100, 1000, 10000):
+    code_list = make_codes(number)
+    for name, bench in (("dict", bench_dict), ("table", bench_table)):
+        try:
+            used, lookup_time = bench(code_list)
+            print(f"{name:5} {number:6} codes: {used:8} bytes, {used / number:6.1f} bytes/code, lookup {lookup_time / 1000:8.1f} us")
+        except MemoryError:
+            print(f"{name:5} {number:6} codes: MemoryError")
+    del code_list
@@ -0,0 +1,118 @@
+# heap benchmark: compartment objects with per-instance state strings and DigitalInOut pin lists (before)
+# vs. __slots__ views on the bytearray state store (compartment.py)
+# runs on the device (copy next to compartment.py) or on a PC: python3 testing/compartment_heap_benchmark.py
+
+import gc
+import sys
+
+try:
+    import tracemalloc  # PC
+except ImportError:  # CircuitPython
+    tracemalloc = None
+
+sys.path.append("..")
+sys.path.append(".")
+
+try:
+    import keypad
+except ImportError:  # PC, doors.py only needs keypad.Event at import
+    import types
+    keypad = types.ModuleType("keypad")
+    keypad.Event = object
+    sys.modules["keypad"] = keypad
+
+try:
+    import microcontroller
+except ImportError:  # PC, no nvm: journal.py is disabled
+    import types
+    microcontroller = types.ModuleType("microcontroller")
+    microcontroller.nvm = None
+    sys.modules["microcontroller"] = microcontroller
+
+import doors
+import locks
+import compartment
+
+compartment_numbers = (32, 64)
+
+
+def mem_used():
+    gc.collect()
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return gc.mem_alloc()
+
+
+# register interface of the MCP23017 used by doors.py and locks.py, no I2C
+class Expander():
+    def __init__(self):
+        self.gpio = 0
+        self.iodir = 0xFFFF
+        self.gppu = 0
+        self.io_control = 0
+        self.interrupt_enable = 0
+        self.interrupt_configuration = 0
+
+
+# what adafruit_mcp230xx DigitalInOut keeps per pin
+class Pin():
+    def __init__(self, expander, pin):
+        self._mcp = expander
+        self._pin = pin
+        self.direction = None
+        self.pull = None
+        self.value = False
+
+
+# compartment as before the state store
+class LegacyCompartment():
+    def __init__(self, input_pin, output_pin):
+        self.type = "small"
+        self.door_status = "closed"
+        self.content_status = "unknown"
+        self.LED_connector = None
+        self.LEDs = None
+        self.status_inputs = [input_pin]
+        self.lock_outputs = [output_pin]
+        self.open_deadline = None
+        self.next_check = 0
+        self.open_callback = None
+        self.open_result = None
+
+
+def bench_legacy(number, expanders):
+    before = mem_used()
+    compartments = {}
+    for index in range(number):
+        expander = expanders[index // 8]
+        position = index % 8
+        comp = LegacyCompartment(Pin(expander, position * 2), Pin(expander, position * 2 + 1))
+        comp.LEDs = [index % 32]
+        comp.content_status = "present"  # set at runtime
+        compartments[str(index + 1)] = comp
+    return mem_used() - before, compartments
+
+
+def bench_store(number, expanders):
+    doors.setup(expanders)
+    locks.setup(expanders)
+    before = mem_used()
+    compartments = {}
+    for index in range(number):
+        position = index % 8
+        comp = compartment.compartment(index + 1, index // 8, position * 2, position * 2 + 1)
+        comp.LEDs = bytearray((index % 32,))
+        comp.content_status = "present"
+        compartments[str(index + 1)] = comp
+    return mem_used() - before, compartments
+
+
+if tracemalloc is not None:
+    tracemalloc.start()
+
+for number in compartment_numbers:
+    expanders = [Expander() for _ in range(number // 8)]
+    for name, bench in (("legacy", bench_legacy), ("store", bench_store)):
+        used, compartments = bench(number, expanders)
+        print(f"{name:6} {number:3} compartments: {used:7} bytes, {used / number:6.1f} bytes/compartment")
+        del compartments
@@ -0,0 +1,166 @@
+# benchmark of flink.py and the code cache against the local Flink stand-in, runs on a PC without network access.
+# the device networking module (wifi, socketpool) is replaced by a small http.client session with the same interface.
+# check_code() in code.py answers 4 digit codes with codes.lookup(), which is what is measured as "check_code"
+# usage: python3 testing/flink_benchmark.py --latency 50 --error-rate 0.05 --codes 1000 --iterations 200
+
+import os
+import sys
+import json
+import time
+import types
+import socket
+import random
+import tempfile
+import http.client
+from urllib.parse import urlsplit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(1, os.path.join(root, "lib"))
+sys.path.insert(2, os.path.join(root, "testing"))
+
+import flink_standin
+
+
+# host version of the adafruit_requests response/session used by flink.py
+class HostResponse():
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status
+
+    def iter_content(self, chunk_size):
+        while True:
+            chunk = self.response.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def json(self):
+        return json.loads(self.response.read())
+
+    def close(self):
+        self.response.read()  # drain, so the keep-alive connection can be reused
+
+
+class HostSession():
+    def __init__(self, ssl_context):
+        self.ssl_context = ssl_context
+        self.connections = {}
+
+    def request(self, method, url, json=None, headers=None, timeout=60):
+        parts = urlsplit(url)
+        connection = self.connections.get(parts.netloc)
+        if connection is None:
+            connection = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+            connection.connect()
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[parts.netloc] = connection
+            self.ssl_context.handshakes += 1  # counts new connections, like the TLS handshakes on the device
+        body = None
+        headers = dict(headers or {})
+        if json is not None:
+            body = globals()["json"].dumps(json).encode()
+            headers["Content-Type"] = "application/json"
+        try:
+            connection.request(method, parts.path, body=body, headers=headers)
+            return HostResponse(connection.getresponse())
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            del self.connections[parts.netloc]
+            raise
+
+
+def install_networking():
+    networking = types.ModuleType("networking")
+    networking.ssl_context = types.SimpleNamespace(handshakes=0, handshakes_by_host={})
+    networking.requests = HostSession(networking.ssl_context)
+    sys.modules["networking"] = networking
+    return networking
+
+
+class QuietLogger():
+    def __init__(self):
+        self.errors = 0
+
+    def error(self, message):
+        self.errors += 1
+
+    def warning(self, message):
+        pass
+
+    def info(self, message):
+        pass
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def report(name, samples, duration):
+    samples_ms = [sample / 1e6 for sample in samples]
+    print(f"{name:16} {len(samples):6} calls {len(samples) / duration:10.1f}/s  "
+          f"p50 {percentile(samples_ms, 0.50):9.3f} ms  p95 {percentile(samples_ms, 0.95):9.3f} ms  p99 {percentile(samples_ms, 0.99):9.3f} ms")
+
+
+def measure(name, function, iterations):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        before = time.perf_counter_ns()
+        function()
+        samples.append(time.perf_counter_ns() - before)
+    report(name, samples, time.perf_counter() - start)
+
+
+def main(argv):
+    parser = flink_standin.argument_parser("Benchmark of flink.py against the local Flink stand-in")
+    parser.add_argument("--iterations", type=int, default=100, help="calls per endpoint")
+    args = parser.parse_args(argv)
+    iterations = args.iterations
+    config = flink_standin.StandinConfig(args.latency / 1000, args.jitter / 1000, args.error_rate, args.codes, windows=args.windows)
+    server = flink_standin.start(config)
+
+    os.environ["FLINK_URL"] = f"http://127.0.0.1:{server.server_port}"
+    os.environ["ID"] = "benchmark"
+    os.environ["FLINK_API_KEY"] = "benchmark"
+    networking = install_networking()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)  # outbox files are created relative to the root on the device
+
+    import flink
+    import codes
+    flink.breaker.failure_threshold = iterations * 10  # measure the raw calls, not the breaker
+    codes.offline_file = os.path.join(workdir, "codes.bin")
+    logger = QuietLogger()
+    entry = {"time": flink.format_time(), "code_entered": "1234", "compartment": "1", "content": "present", "door": "closed"}
+
+    print(f"stand-in: latency {args.latency} ms, jitter {args.jitter} ms, error rate {args.error_rate}, {args.codes} codes")
+    measure("put_status", lambda: flink.put_status(logger, time.monotonic(), 1, "bench", 32, []), iterations)
+    measure("get_codes", lambda: flink.get_codes(logger, lambda comp, code, valid_from, valid_until: None), iterations)
+    measure("codes.refresh", lambda: codes.refresh(logger), iterations)
+    measure("post_code_log", lambda: flink.post_code_log(logger, [entry]), iterations)
+
+    test_codes = [f"{random.randint(0, 9999):04}" for _ in range(iterations * 10)]
+    position = [0]
+
+    def check_cached():
+        codes.lookup(test_codes[position[0] % len(test_codes)], logger)
+        position[0] += 1
+
+    def check_stale():
+        codes.last_update = codes.next_refresh = None  # cache too old, goes to the stand-in
+        check_cached()
+
+    codes.refresh(logger)
+    measure("check_code cached", check_cached, iterations * 10)
+    measure("check_code stale", check_stale, iterations)
+
+    print(f"requests: {flink.request_count}, new connections: {networking.ssl_context.handshakes}, errors logged: {logger.errors}")
+    for endpoint_stats in flink.stats.values():
+        print(endpoint_stats)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
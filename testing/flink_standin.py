@@ -0,0 +1,138 @@
+# local stand-in for the Flink key box API, runs on a PC (no network access needed, listens on localhost)
+# endpoints: PUT /<ID>/status, GET /<ID>/codes, POST /<ID>/code_log, POST /<ID>/error_log, POST /<ID>/door_log
+# usage: python3 testing/flink_standin.py --port 8080 --latency 50 --error-rate 0.05 --codes 1000
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandinConfig():
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, codes=100, compartments=32, windows=False):
+        self.latency = latency  # seconds added to every response
+        self.jitter = jitter  # random additional latency, seconds
+        self.error_rate = error_rate  # share of requests answered with 500
+        self.codes = codes  # number of codes in the /codes response
+        self.compartments = compartments
+        self.windows = windows  # send codes as objects with validity window
+        self.requests = 0
+        self.received = {"status": 0, "code_log": 0, "error_log": 0, "door_log": 0}
+        self.lock = threading.Lock()
+        self.codes_body = None
+
+    # /codes response, generated once
+    def codes_document(self):
+        if self.codes_body is None:
+            rng = random.Random(1)
+            document = {}
+            for index in range(self.codes):
+                comp = str(index % self.compartments + 1)
+                code = f"{rng.randint(0, 9999):04}"
+                if self.windows:
+                    now = int(time.time())
+                    code = {"code": code, "valid_from": now - 3600, "valid_until": now + 86400}
+                document.setdefault(comp, []).append(code)
+            self.codes_body = json.dumps(document).encode()
+        return self.codes_body
+
+
+def make_handler(config):
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like Flink
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def endpoint(self):
+            return self.path.split("?")[0].rstrip("/").split("/")[-1]
+
+        def delay_or_fail(self):
+            with config.lock:
+                config.requests += 1
+            time.sleep(config.latency + random.random() * config.jitter)
+            if random.random() < config.error_rate:
+                self.reply(500, b'{"error": "stand-in error"}')
+                return True
+            return False
+
+        def reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length) if length > 0 else b""
+
+        def do_GET(self):
+            if self.delay_or_fail():
+                return
+            if self.endpoint() == "codes":
+                self.reply(200, config.codes_document())
+            else:
+                self.reply(404, b"{}")
+
+        def do_PUT(self):
+            self.read_body()
+            if self.delay_or_fail():
+                return
+            if self.endpoint() == "status":
+                with config.lock:
+                    config.received["status"] += 1
+                self.reply(200, b"{}")
+            else:
+                self.reply(404, b"{}")
+
+        def do_POST(self):
+            body = self.read_body()
+            if self.delay_or_fail():
+                return
+            endpoint = self.endpoint()
+            if endpoint in ("code_log", "error_log", "door_log"):
+                entries = json.loads(body or b"[]")
+                with config.lock:
+                    config.received[endpoint] += len(entries) if type(entries) is list else 1
+                self.reply(201, b"{}")
+            else:
+                self.reply(404, b"{}")
+
+    return StandinHandler
+
+
+# start the stand-in in a background thread, returns the server (server.server_port is the port)
+def start(config, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def argument_parser(description="Local Flink stand-in"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="ms added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random additional ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--codes", type=int, default=100, help="number of codes in the /codes response")
+    parser.add_argument("--windows", action="store_true", help="send codes with validity windows")
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args(sys.argv[1:])
+    config = StandinConfig(args.latency / 1000, args.jitter / 1000, args.error_rate, args.codes, windows=args.windows)
+    server = start(config, args.port)
+    print(f"Flink stand-in on http://127.0.0.1:{server.server_port}/<ID>/, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,83 @@
+# Ziemann Engineering Schlüsselkasten-Software
+# compartment topology: which spaces, IO pins and LEDs belong to which compartment, computed once at boot
+
+# SPDX-FileCopyrightText: 2023 Thomas Ziemann for Ziemann Engineering
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# spaces are the spots where a single compartment can be, numbered from 1 along the rows:
+# space = expander_index * 8 + position + 1, position 0-7 uses input pin 2 * position and output pin 2 * position + 1.
+# the space below is space + 8 (next expander). LEDs are numbered the same way, 32 per connector.
+spaces_per_expander = 8
+LEDs_per_connector = 32
+
+# compartment shapes (width x height in spaces): spaces taken besides the first, as offsets
+shapes = {
+    "1x1": (),
+    "2x1": (1,), # wide, one lock
+    "1x2": (8,), # tall, locks of both spaces
+    "2x2": (1, 8, 9), # large, locks of the left spaces
+}
+default_shape = "2x2" # LARGE_COMPARTMENTS entries without shape
+
+# tables per compartment, index: compartment number - 1
+io = [] # list of (expander index, input pin, output pin)
+LEDs = [] # bytearray of LED indices on the connector
+connectors = bytearray() # LED connector index
+sizes = bytearray() # number of spaces taken
+space_compartment = bytearray() # compartment number per space (index: space - 1), 0: unused
+
+
+# "5 9:2x1 13:1x2" -> {5: "2x2", 9: "2x1", 13: "1x2"}
+def parse_layout(entries):
+    layout = {}
+    for entry in entries:
+        space, _, shape = entry.partition(":")
+        shape = shape or default_shape
+        if shape not in shapes:
+            raise ValueError(f"unknown compartment shape {shape} in {entry}")
+        layout[int(space)] = shape
+    return layout
+
+
+# fill the tables for expander_count rows, layout: {first space: shape} of the compartments larger than one space
+def build(expander_count, layout):
+    global connectors, sizes, space_compartment
+    io.clear()
+    LEDs.clear()
+    connectors = bytearray()
+    sizes = bytearray()
+    space_count = expander_count * spaces_per_expander
+    space_compartment = bytearray(space_count)
+    for space in layout:
+        if space < 1 or space > space_count:
+            raise ValueError(f"compartment at space {space} outside of the {space_count} spaces")
+    for space in range(1, space_count + 1):
+        if space_compartment[space - 1] != 0:
+            if space in layout:
+                raise ValueError(f"compartment at space {space} overlaps compartment {space_compartment[space - 1]}")
+            continue
+        shape = layout.get(space, "1x1")
+        taken = [space]
+        for offset in shapes[shape]:
+            other = space + offset
+            if offset % spaces_per_expander != 0 and (space - 1) % spaces_per_expander == spaces_per_expander - 1:
+                raise ValueError(f"{shape} compartment at space {space} crosses the end of the row")
+            if other > space_count:
+                raise ValueError(f"{shape} compartment at space {space} extends below the last row")
+            if space_compartment[other - 1] != 0:
+                raise ValueError(f"{shape} compartment at space {space} overlaps space {other}")
+            if (other - 1) // LEDs_per_connector != (space - 1) // LEDs_per_connector:
+                raise ValueError(f"{shape} compartment at space {space} spans two LED connectors")
+            taken.append(other)
+        number = len(io) + 1
+        pins = []
+        for other in taken:
+            space_compartment[other - 1] = number
+            if (other - space) % spaces_per_expander == 0: # left column of the compartment: IO pair used
+                position = (other - 1) % spaces_per_expander
+                pins.append(((other - 1) // spaces_per_expander, position * 2, position * 2 + 1))
+        io.append(pins)
+        LEDs.append(bytearray((other - 1) % LEDs_per_connector for other in taken))
+        connectors.append((space - 1) // LEDs_per_connector)
+        sizes.append(len(taken))
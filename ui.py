@@ -8,7 +8,8 @@ import pwmio
 import fourwire
 import displayio
 import time
-import microcontroller
+
+import compartment
 
 from adafruit_display_text import bitmap_label
 from adafruit_bitmap_font import bitmap_font
@@ -19,7 +20,7 @@ from adafruit_display_shapes.rect import Rect
 
 displayio.release_displays()
 
-from hardware import LED_internal, LED_connector_1, LED_connector_2, backlight, haptic, read_keypad
+from hardware import LED_internal, LED_connector_1, LED_connector_2, backlight, haptic
 
 # import adafruit_miniqr
 
@@ -79,12 +80,6 @@ no_power, palette = adafruit_imageload.load("/images/power_off.bmp", bitmap=disp
 no_power_grid = displayio.TileGrid(no_power, pixel_shader=palette, x=290, y=0)
 no_power_grid.hidden = True
 
-# open all compartments
-def open_all(compartments):
-    for index in range(len(compartments)):
-        compartments[str(index + 1)].open()
-        microcontroller.watchdog.feed() # feed the watchdog
-
 def main():
     # use global keyword to access UI elements, not the prettiest way of doing it
     global code_label, status_label, icons1, icons2, no_flink_grid, no_wifi_grid, maintainance_grid, warning_grid, no_power_grid, low_battery_grid, welcome_text, invalid_text
@@ -129,104 +124,152 @@ def main():
     display.root_group = main
 
 
-# deal with compartment open/close logic
-def process_compartment(compartments, compartment_index, logger):
-    # code valid
-    if compartment_index is not None:
-        if compartment_index in compartments:
-            compartments[compartment_index].set_LEDs((50,50,50))
-            LED_internal.fill((15,50,0))
-            status_label.text = f"Fach {compartment_index} wird geöffnet."
-            time.sleep(1) # wait a second for the user to read
-            status = compartments[compartment_index].open(1)
-            if compartments[compartment_index].content_status == "present":
-                task1 = "entnehmen"
-                task2 = "entnommen"
-            elif compartments[compartment_index].content_status == "empty":
-                task1 = "einlegen"
-                task2 = "eingelegt"
-            else:
-                instruction = "einlegen/entnehmen"
-            # successfully opened
-            if status == True:
-                status_label.text = f"Bitte Inhalt entnehmen\n    oder zurücklegen  \nund Fach {compartment_index} schliessen."
-                time.sleep(1) # wait a second for the user to read
-            # not successfully opened, try again
+# deal with compartment open/close logic. the dialogue is a state machine: update() is called from the main loop
+# with the newly pressed key (or None) and advances it without blocking, waiting times are deadlines
+close_timeout = 60 # seconds to wait for the user to close the door
+answer_timeout = 60 # seconds to wait for the answer to the content question
+door_check_time = 0.1 # seconds between door checks while waiting for the door to close
+
+class Transaction():
+    def __init__(self, compartments, compartment_index, logger):
+        self.compartments = compartments
+        self.compartment_index = compartment_index
+        self.logger = logger
+        self.comp = None
+        self.batch = None
+        self.task2 = None
+        self.state = None
+        self.next_state = None
+        self.next_timeout = 0
+        self.deadline = 0
+        self.next_check = 0
+        self.done = False
+        # code valid
+        if compartment_index is not None:
+            if compartment_index in compartments:
+                self.comp = compartments[compartment_index]
+                self.comp.set_LEDs((50,50,50))
+                LED_internal.fill((15,50,0))
+                status_label.text = f"Fach {compartment_index} wird geöffnet."
+                self.wait(1, "open") # wait a second for the user to read
+            elif compartment_index == "99":
+                LED_internal.fill((15,50,0))
+                status_label.text = f"Alle Fächer werden geöffnet."
+                self.state = "open_all"
             else:
-                status_label.text = f"Fach blockiert?\nBitte drücke\n leicht auf Fach {compartment_index}."
-                time.sleep(5) # wait for the user to read and check
-                status = compartments[compartment_index].open(3)
-                if status == True: # successfully opened
-                    status_label.text = f"Bitte Inhalt entnehmen\n  oder zurücklegen  \nund Fach {compartment_index} schliessen."
+                logger.warning(f"Code valid for non-existent / not connected compartment.")
+                LED_internal.fill((90,0,0))
+                status_label.text="      Code ist für nicht      \nverbundenes/eingerichtetes\n      Fach bestimmt.      "
+                self.wait(3, "end")
+        # code invalid
+        else:
+            LED_internal.fill((90,0,0))
+            status_label.text=invalid_text
+            self.wait(3, "end")
+
+    # go to next_state after seconds, next_state then has timeout seconds
+    def wait(self, seconds, next_state, timeout=0):
+        self.state = "wait"
+        self.deadline = time.monotonic() + seconds
+        self.next_state = next_state
+        self.next_timeout = timeout
+
+    def enter(self, state, timeout=0):
+        self.state = state
+        self.deadline = time.monotonic() + timeout
+
+    # advance the dialogue, key is the newly pressed key or None. returns True when the transaction is finished
+    def update(self, key):
+        now = time.monotonic()
+        state = self.state
+        if state == "wait":
+            if now >= self.deadline:
+                self.enter(self.next_state, self.next_timeout)
+        elif state == "open":
+            if self.comp.content_status == "present":
+                self.task2 = "entnommen"
+            elif self.comp.content_status == "empty":
+                self.task2 = "eingelegt"
+            self.comp.start_open(1)
+            self.state = "opening"
+        elif state == "opening" or state == "opening_retry":
+            if not self.comp.is_opening():
+                if self.comp.open_result == True: # successfully opened
+                    status_label.text = f"Bitte Inhalt entnehmen\n    oder zurücklegen  \nund Fach {self.compartment_index} schliessen."
+                    if state == "opening":
+                        self.wait(1, "wait_close", close_timeout) # wait a second for the user to read
+                    else:
+                        self.enter("wait_close", close_timeout)
+                elif state == "opening": # not successfully opened, try again
+                    status_label.text = f"Fach blockiert?\nBitte drücke\n leicht auf Fach {self.compartment_index}."
+                    self.wait(5, "open_retry") # wait for the user to read and check
                 else:
                     status_label.text = f"Fach öffnet sich nicht.\nBitte erneut versuchen,\noder Alternative buchen."
-                    logger.error(f"Door {compartment_index} did not open.")
-                    time.sleep(8) # wait for user to read
-            # wait for user to close door
-            counter = 600
-            while compartments[compartment_index].get_inputs() == True and counter > 0:
-                time.sleep(0.1)
-                counter -= 1
-                reply = read_keypad()
-                if reply == "x":
-                    counter = 0 # break loop and treat is as no answer
-                microcontroller.watchdog.feed() # feed the watchdog
-            if counter == 0:
-                logger.warning(f"Door {compartment_index} not closed.")
-                compartments[compartment_index].door_status = "open"
-            else:
-                compartments[compartment_index].door_status = "closed"
+                    self.logger.error(f"Door {self.compartment_index} did not open.")
+                    self.wait(8, "wait_close", close_timeout) # wait for user to read
+        elif state == "open_retry":
+            self.comp.start_open(3)
+            self.state = "opening_retry"
+        elif state == "wait_close": # wait for user to close door
+            if key == "x" or now >= self.deadline: # treat "x" as no answer
+                self.logger.warning(f"Door {self.compartment_index} not closed.")
+                self.comp.door_status = "open"
+                self.ask()
+            elif now >= self.next_check:
+                self.next_check = now + door_check_time
+                if self.comp.get_inputs() == False:
+                    self.comp.door_status = "closed"
+                    self.ask()
+        elif state == "answer":
+            if key == "✓":
+                haptic.play()
+                if self.comp.content_status == "unknown" or self.comp.content_status == "empty":
+                    self.comp.content_status = "present"
+                else:
+                    self.comp.content_status = "empty"
+                self.finish()
+            elif key == "x":
+                haptic.play()
+                if self.comp.content_status == "unknown" or self.comp.content_status == "empty":
+                    self.comp.content_status = "empty"
+                else:
+                    self.comp.content_status = "present"
+                self.finish()
+            elif now >= self.deadline:
+                self.logger.warning(f"User did not answer status question.")
+                self.comp.content_status = "unknown"
+                self.finish()
+        elif state == "open_all":
+            self.batch = compartment.OpenAll(self.compartments)
+            self.state = "opening_all"
+        elif state == "opening_all":
+            if self.batch.done:
+                if len(self.batch.failed) > 0:
+                    self.logger.warning(f"Compartments did not open: {self.batch.failed}")
+                    status_label.text = f"Nicht geöffnet:\n{', '.join(self.batch.failed)}"
+                    self.wait(3, "end")
+                else:
+                    self.state = "end"
+        elif state == "end":
+            LED_internal.fill((30,30,30))
+            code_label.text = ""
+            status_label.text=welcome_text
+            self.done = True
+        return self.done
 
-            # ask for content status
-            counter = 600
-            if compartments[compartment_index].content_status == "unknown":
-                status_label.text = f"      Hast du etwas  \n    zurückgelegt (    )\noder entnommen (    )?"
-                icons1.hidden = False
-            else:
-                status_label.text = f"Hast du den Inhalt\n      {task2}?\n    Nein:        Ja:     "
-                icons2.hidden = False
-            while counter > 0:
-                time.sleep(0.1)
-                counter -= 1
-                microcontroller.watchdog.feed() # feed the watchdog
-                reply = read_keypad()
-                if reply == "✓":
-                    haptic.play()
-                    if compartments[compartment_index].content_status == "unknown" or compartments[compartment_index].content_status == "empty":
-                        compartments[compartment_index].content_status = "present"
-                    else:
-                        compartments[compartment_index].content_status = "empty"
-                    break
-                elif reply == "x":
-                    haptic.play()
-                    if compartments[compartment_index].content_status == "unknown" or compartments[compartment_index].content_status == "empty":
-                        compartments[compartment_index].content_status = "empty"
-                    else:
-                        compartments[compartment_index].content_status = "present"
-                    break
-            if counter == 0:
-                logger.warning(f"User did not answer status question.")
-                compartments[compartment_index].content_status = "unknown"
-
-            # reset UI
-            icons1.hidden = True
-            icons2.hidden = True
-            compartments[compartment_index].set_LEDs((0,0,0))
-        elif compartment_index == "99":
-            LED_internal.fill((15,50,0))
-            status_label.text = f"Alle Fächer werden geöffnet."
-            open_all(compartments)
+    # ask for content status
+    def ask(self):
+        if self.comp.content_status == "unknown":
+            status_label.text = f"      Hast du etwas  \n    zurückgelegt (    )\noder entnommen (    )?"
+            icons1.hidden = False
         else:
-            logger.warning(f"Code valid for non-existent / not connected compartment.")
-            LED_internal.fill((90,0,0))
-            status_label.text="      Code ist für nicht      \nverbundenes/eingerichtetes\n      Fach bestimmt.      "
-            time.sleep(3)
-    # code invalid
-    else:
-        LED_internal.fill((90,0,0))
-        status_label.text=invalid_text
-        time.sleep(3)
-
-    LED_internal.fill((30,30,30))
-    code_label.text = ""
-    status_label.text=welcome_text
+            status_label.text = f"Hast du den Inhalt\n      {self.task2}?\n    Nein:        Ja:     "
+            icons2.hidden = False
+        self.enter("answer", answer_timeout)
+
+    # reset UI
+    def finish(self):
+        icons1.hidden = True
+        icons2.hidden = True
+        self.comp.set_LEDs((0,0,0))
+        self.state = "end"